@@ -0,0 +1,297 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import sys
+import time
+import datetime
+import numpy
+import pandas
+import warnings
+from typing import Dict, List, Optional, Tuple
+from numpy.lib.stride_tricks import sliding_window_view
+from bson.binary import Binary
+
+from cimetrics.env import get_env
+
+# Anomalies are level shifts: points where the median of the window
+# of values that follows differs from the median of the window that
+# precedes by more than c times the interquartile range of those
+# differences above their third quartile. Only the first point of each
+# run of such points is reported, as an integer position in the series.
+DETECTORS = ("builtin", "adtk")
+# Scores persisted in the detector state, as a build x metric matrix
+SCORE_TYPE = "<f8"
+
+
+def rolling_medians(values: numpy.ndarray, window: int):
+    """
+    Medians of the window values before (left) and from (right) each
+    row of values, for all columns at once. Windows that are not full
+    or that contain NaN have a NaN median.
+    """
+    n, k = values.shape
+    left = numpy.full((n, k), numpy.nan)
+    right = numpy.full((n, k), numpy.nan)
+    if n >= window:
+        medians = numpy.median(sliding_window_view(values, window, axis=0), axis=-1)
+        left[window:] = medians[: n - window]
+        right[: n - window + 1] = medians
+    return left, right
+
+
+def level_shift_scores(values: numpy.ndarray, window: int) -> numpy.ndarray:
+    """
+    Absolute difference between the right and left rolling medians of
+    each row of values.
+    """
+    left, right = rolling_medians(values, window)
+    return numpy.abs(right - left)
+
+
+def shift_starts(l1: numpy.ndarray, c: float = 3.0) -> numpy.ndarray:
+    """
+    Whether each row of l1 starts a run of anomalous scores, per column.
+    """
+    with warnings.catch_warnings():
+        # All-NaN columns have no anomalies
+        warnings.simplefilter("ignore", RuntimeWarning)
+        q1, q3 = numpy.nanquantile(l1, [0.25, 0.75], axis=0)
+    shifted = l1 > q3 + c * (q3 - q1)
+    starts = numpy.zeros_like(shifted)
+    starts[1:] = shifted[1:] & ~shifted[:-1]
+    return starts
+
+
+def positions(df: pandas.DataFrame, starts: numpy.ndarray) -> Dict[str, List[int]]:
+    return {
+        col: numpy.flatnonzero(starts[:, i]).tolist()
+        for i, col in enumerate(df.columns)
+    }
+
+
+def level_shifts(
+    df: pandas.DataFrame, window: int, c: float = 3.0
+) -> Dict[str, List[int]]:
+    """
+    Positions of the level shifts of each column of df, computed on all
+    columns at once. Matches adtk's LevelShiftAD(window, c).
+    """
+    l1 = level_shift_scores(df.to_numpy(dtype=float), window)
+    return positions(df, shift_starts(l1, c))
+
+
+def adtk_level_shifts(
+    df: pandas.DataFrame, window: int, c: float = 3.0
+) -> Dict[str, List[int]]:
+    """
+    Positions of the level shifts of each column of df, detected
+    column by column with adtk.
+    """
+    from adtk.detector import LevelShiftAD
+
+    shifts = {}
+    for col in df.columns:
+        series = df[col].to_frame()
+        try:
+            ts = series.set_index(
+                pandas.date_range(start="1/1/1970", periods=len(series))
+            )
+            ad = LevelShiftAD(window=window, c=c)
+            an = ad.fit_detect(ts).fillna(0).diff().fillna(0).reset_index(drop=True)
+            shifts[col] = an[an > 0].dropna().index.tolist()
+        except RuntimeError as err:
+            print(f"Could not detect anomalies: {err}")
+            shifts[col] = []
+    return shifts
+
+
+def anomalies(
+    df: pandas.DataFrame, window_size: int, detector: str = "builtin"
+) -> Dict[str, List[int]]:
+    if detector == "adtk":
+        return adtk_level_shifts(df, window_size)
+    elif detector == "builtin":
+        return level_shifts(df, window_size)
+    raise ValueError(f"Unsupported anomaly detector: {detector}")
+
+
+def anomalies_collection(col):
+    return col.database[f"{col.name}_anomalies"]
+
+
+def incremental_scores(
+    df: pandas.DataFrame, window: int, state: Optional[dict]
+) -> numpy.ndarray:
+    """
+    Level shift scores of df, only computed for the rows whose windows
+    hold builds that were not scored yet, and for new metrics. Other
+    scores are read from state. Scores match those computed on df alone:
+    the first window rows have no score, even if their left window was
+    scored in state, since it starts before df.
+    """
+    values = df.to_numpy(dtype=float)
+    build_ids = df.index.tolist()
+    scored = {b: i for i, b in enumerate(state["build_ids"])} if state else {}
+    first_new = next(
+        (i for i, b in enumerate(build_ids) if b not in scored), len(build_ids)
+    )
+    offset = scored[build_ids[0]] if first_new else 0
+    if (
+        state is None
+        or state["build_ids"][offset : offset + first_new] != build_ids[:first_new]
+    ):
+        return level_shift_scores(values, window)
+
+    l1 = numpy.full(values.shape, numpy.nan)
+    reuse = max(0, first_new - window + 1)
+    start = max(0, reuse - window)
+    l1[reuse:] = level_shift_scores(values[start:], window)[reuse - start :]
+    previous = numpy.frombuffer(state["l1"], dtype=SCORE_TYPE).reshape(
+        len(state["build_ids"]), len(state["names"])
+    )
+    index = {name: j for j, name in enumerate(state["names"])}
+    known = [j for j, name in enumerate(df.columns) if name in index]
+    new_columns = [j for j, name in enumerate(df.columns) if name not in index]
+    l1[:reuse, known] = previous[
+        offset : offset + reuse, [index[df.columns[j]] for j in known]
+    ]
+    if new_columns:
+        l1[:, new_columns] = level_shift_scores(values[:, new_columns], window)
+    l1[:window] = numpy.nan
+    return l1
+
+
+def incremental_anomalies(
+    col,
+    branch: str,
+    df: pandas.DataFrame,
+    window: int,
+    c: float = 3.0,
+    build_numbers: Optional[Dict[int, str]] = None,
+) -> Tuple[Dict[str, List[int]], List[dict]]:
+    """
+    Positions of the level shifts of each column of df, the history of
+    branch indexed by build id, using and updating the detector state
+    persisted for branch. Also returns an event for each shift that had
+    not been detected by previous runs. Shifts present when the state
+    is first created are recorded without being reported.
+    """
+    store = anomalies_collection(col)
+    state = store.find_one({"_id": branch})
+    if state is not None and (state.get("window") != window or state.get("c") != c):
+        state = None
+    l1 = incremental_scores(df, window, state)
+    starts = shift_starts(l1, c)
+
+    values = df.to_numpy(dtype=float)
+    build_ids = df.index.tolist()
+    reported = dict(zip(state["names"], state["shifts"])) if state else {}
+    events = []
+    shifts = []
+    for j, name in enumerate(df.columns):
+        starts_j = numpy.flatnonzero(starts[:, j]).tolist()
+        for i in starts_j:
+            if state is not None and build_ids[i] not in reported.get(name, ()):
+                events.append(
+                    {
+                        "branch": branch,
+                        "metric": name,
+                        "build_id": build_ids[i],
+                        "build_number": (build_numbers or {}).get(build_ids[i]),
+                        "before": float(
+                            numpy.median(values[max(0, i - window) : i, j])
+                        ),
+                        "after": float(numpy.median(values[i : i + window, j])),
+                        "detected": datetime.datetime.now().isoformat(),
+                    }
+                )
+        in_span = set(reported.get(name, ())).intersection(build_ids)
+        shifts.append(sorted(in_span.union(build_ids[i] for i in starts_j)))
+    store.replace_one(
+        {"_id": branch},
+        {
+            "_id": branch,
+            "window": window,
+            "c": c,
+            "build_ids": build_ids,
+            "names": list(df.columns),
+            "l1": Binary(l1.astype(SCORE_TYPE).tobytes()),
+            "shifts": shifts,
+        },
+        upsert=True,
+    )
+    return positions(df, starts), events
+
+
+def check_incremental(
+    df: pandas.DataFrame, window: int, span: int, c: float = 3.0
+) -> List[Tuple[int, str]]:
+    """
+    Replay incremental detection on each span-long slice of df, one build
+    at a time, and compare the shifts detected in each slice with those
+    computed on the slice alone. Returns the (last build id, metric) of
+    each mismatch.
+    """
+    state = None
+    mismatches = []
+    for end in range(min(span, len(df)), len(df) + 1):
+        view = df.iloc[max(0, end - span) : end]
+        l1 = incremental_scores(view, window, state)
+        incremental = positions(view, shift_starts(l1, c))
+        full = level_shifts(view, window, c)
+        mismatches += [
+            (view.index[-1], col)
+            for col in view.columns
+            if incremental[col] != full[col]
+        ]
+        state = {
+            "build_ids": view.index.tolist(),
+            "names": list(view.columns),
+            "l1": Binary(l1.astype(SCORE_TYPE).tobytes()),
+        }
+    return mismatches
+
+
+if __name__ == "__main__":
+    # Compare both detectors on the monitored history of the target branch
+    from cimetrics.plot import Metrics
+
+    env = get_env()
+    if env is None:
+        print("Skipping anomaly detection (env)")
+        sys.exit(0)
+
+    history, _ = Metrics(env).branch_history(
+        {"branch": env.target_branch}, max_builds=env.monitoring_span
+    )
+    results = {}
+    for detector in DETECTORS:
+        start = time.perf_counter()
+        results[detector] = anomalies(history, env.ewma_span, detector)
+        elapsed = time.perf_counter() - start
+        print(f"{detector}: {elapsed * 1000:.1f}ms")
+    mismatches = [
+        col
+        for col in history.columns
+        if results["builtin"][col] != results["adtk"][col]
+    ]
+    print(
+        f"{len(history.columns) - len(mismatches)}/{len(history.columns)} metrics"
+        f" over {len(history)} builds with identical anomalies"
+    )
+    for col in mismatches:
+        print(
+            f"  {col}: builtin {results['builtin'][col]}, adtk {results['adtk'][col]}"
+        )
+
+    # Incremental detection, replayed over the last builds, must match
+    # a full recompute of each monitored span
+    span = len(history) // 2
+    incremental_mismatches = check_incremental(history, env.ewma_span, span)
+    print(
+        f"{len(incremental_mismatches)} mismatches of incremental detection"
+        f" over {len(history) - span + 1} spans of {span} builds"
+    )
+    for build_id, col in incremental_mismatches:
+        print(f"  {col} up to build {build_id}")
+    sys.exit(1 if mismatches or incremental_mismatches else 0)
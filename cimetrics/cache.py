@@ -0,0 +1,165 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import json
+import time
+import datetime
+import sqlite3
+
+CACHE_FILE = "history.sqlite"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS histories (
+    key TEXT PRIMARY KEY,
+    depth INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    key TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    build_id INTEGER NOT NULL,
+    build_number TEXT,
+    created TEXT NOT NULL,
+    metrics TEXT NOT NULL,
+    PRIMARY KEY (key, doc_id)
+);
+CREATE INDEX IF NOT EXISTS documents_created ON documents (key, created);
+"""
+
+
+class HistoryCache(object):
+    """
+    On-disk cache of the documents making up a branch history, keyed by
+    history query. Only documents created after the newest cached one,
+    less an overlap for documents inserted late, need to be fetched to
+    bring a history up to date.
+    """
+
+    def __init__(self, path, max_age_days=7, max_size_mb=100, overlap_minutes=15):
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.join(path, CACHE_FILE)
+        self.max_age = max_age_days * 24 * 3600
+        self.max_size = max_size_mb * 1024 * 1024
+        self.overlap = datetime.timedelta(minutes=overlap_minutes)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    @staticmethod
+    def key(col, branch_query):
+        query = json.dumps(branch_query, sort_keys=True, default=str)
+        return f"{col.database.name}.{col.name}:{query}"
+
+    def high_water_mark(self, key, depth):
+        """
+        Creation time of the newest document cached for key, less the
+        overlap, or None if the cached history is missing or shallower
+        than depth builds. Documents are inserted some time after their
+        creation time (e.g. when buffered, or published at the end of a
+        long build), so those created just before the newest cached one
+        may not have been cached yet. Refetching them is harmless, as
+        cached documents are replaced.
+        """
+        row = self.db.execute(
+            "SELECT depth FROM histories WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[0] < depth:
+            return None
+        (created,) = self.db.execute(
+            "SELECT MAX(created) FROM documents WHERE key = ?", (key,)
+        ).fetchone()
+        if not created:
+            return None
+        return datetime.datetime.strptime(created, DATE_FORMAT) - self.overlap
+
+    def store(self, key, depth, records):
+        """
+        Add records (documents with _id, build_id, build_number, created
+        and metrics) to the history for key, and keep only its latest
+        depth builds.
+        """
+        self.db.executemany(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    key,
+                    str(r["_id"]),
+                    int(r["build_id"]),
+                    r.get("build_number"),
+                    r["created"].strftime(DATE_FORMAT),
+                    json.dumps(r["metrics"]),
+                )
+                for r in records
+                if r.get("build_id")
+            ],
+        )
+        self.db.execute(
+            "INSERT INTO histories VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE"
+            " SET depth = MAX(depth, excluded.depth), accessed = excluded.accessed",
+            (key, depth, time.time()),
+        )
+        depth = self.db.execute(
+            "SELECT depth FROM histories WHERE key = ?", (key,)
+        ).fetchone()[0]
+        self.db.execute(
+            "DELETE FROM documents WHERE key = ? AND build_id NOT IN"
+            " (SELECT build_id FROM documents WHERE key = ?"
+            "  GROUP BY build_id ORDER BY MAX(created) DESC LIMIT ?)",
+            (key, key, depth),
+        )
+        self.db.commit()
+
+    def history(self, key, max_build_id, max_builds):
+        """
+        Cached documents for the last max_builds builds of key, up to
+        max_build_id if specified.
+        """
+        max_build_id = int(max_build_id) if max_build_id is not None else -1
+        rows = self.db.execute(
+            "SELECT build_id, build_number, metrics FROM documents"
+            " WHERE key = ? AND build_id IN"
+            " (SELECT build_id FROM documents WHERE key = ?"
+            "  AND (? < 0 OR build_id <= ?)"
+            "  GROUP BY build_id ORDER BY MAX(created) DESC LIMIT ?)",
+            (key, key, max_build_id, max_build_id, max_builds),
+        )
+        return [
+            {"build_id": bid, "build_number": number, "metrics": json.loads(metrics)}
+            for bid, number, metrics in rows
+        ]
+
+    def evict(self):
+        """
+        Drop histories not accessed for longer than max_age, then least
+        recently accessed histories until the cache fits in max_size.
+        """
+        stale = time.time() - self.max_age
+        self._drop(
+            [
+                key
+                for (key,) in self.db.execute(
+                    "SELECT key FROM histories WHERE accessed < ?", (stale,)
+                ).fetchall()
+            ]
+        )
+        keys = [
+            key
+            for (key,) in self.db.execute(
+                "SELECT key FROM histories ORDER BY accessed"
+            ).fetchall()
+        ]
+        while keys and os.path.getsize(self.path) > self.max_size:
+            self._drop([keys.pop(0)])
+
+    def _drop(self, keys):
+        if not keys:
+            return
+        for key in keys:
+            self.db.execute("DELETE FROM documents WHERE key = ?", (key,))
+            self.db.execute("DELETE FROM histories WHERE key = ?", (key,))
+        self.db.commit()
+        self.db.execute("VACUUM")
+
+    def close(self):
+        self.db.close()
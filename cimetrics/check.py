@@ -0,0 +1,70 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import sys
+import json
+from typing import List
+
+from cimetrics.env import get_env
+
+# Written by cimetrics.plot on Pull Requests
+REPORT_PATH = "_cimetrics/diff.json"
+
+
+def worse_change(metric: dict) -> float:
+    """
+    Change of the metric in percent, positive when it got worse (lower
+    for metrics whose name ends with "^", higher otherwise).
+    """
+    change = metric["change"]
+    return -change if metric["metric"].endswith("^") else change
+
+
+def violations(report: dict, thresholds: dict) -> List[dict]:
+    """
+    Metrics of the report that regressed by more than the threshold of
+    their group, in percent. With the significance test, the verdict and
+    the change from the moving average may disagree in direction, in
+    which case the metric did not regress beyond its threshold.
+    """
+    failed = []
+    for metric in report["metrics"]:
+        threshold = thresholds.get(metric["group"])
+        if (
+            threshold is not None
+            and metric["verdict"] == "regression"
+            and metric["change"] is not None
+            and worse_change(metric) > threshold
+        ):
+            failed.append(dict(metric, threshold=threshold))
+    return failed
+
+
+if __name__ == "__main__":
+    env = get_env()
+    if env is None:
+        print("Skipping check (env)")
+        sys.exit(0)
+
+    if not env.is_pr:
+        print("Skipping check (not a Pull Request)")
+        sys.exit(0)
+
+    path = os.path.join(env.repo_root, REPORT_PATH)
+    if not os.path.exists(path):
+        sys.exit(f"{path} does not exist. Run python -m cimetrics.plot first.")
+
+    with open(path) as f:
+        report = json.load(f)
+
+    failed = violations(report, env.thresholds)
+    for metric in failed:
+        print(
+            f"{metric['metric']} regressed by {worse_change(metric):.2f}%"
+            f" ({metric['baseline']:.4g} -> {metric['value']:.4g}),"
+            f" more than the {metric['threshold']}% allowed for {metric['group']}"
+        )
+    if failed:
+        sys.exit(1)
+    print("No metric regressed beyond the threshold of its group")
@@ -0,0 +1,164 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import sys
+import numpy
+import pandas
+import pymongo
+from bson.binary import Binary
+from typing import Dict, List
+
+from cimetrics.env import get_env
+from cimetrics.connection import get_collection
+
+# Compact documents store metric ids and values as parallel arrays of
+# little-endian int32 and float64, instead of a {name: {"value": ...}}
+# dict. Metric ids are assigned in a separate collection of names.
+SCHEMA_VERSION = 2
+ID_TYPE = "<i4"
+VALUE_TYPE = "<f8"
+
+# Ids of known metric names, by names collection
+_ids: Dict[str, Dict[str, int]] = {}
+
+
+def names_collection(col):
+    names = col.database[f"{col.name}_names"]
+    if names.full_name not in _ids:
+        names.create_index("name", unique=True)
+        _ids[names.full_name] = {}
+    return names
+
+
+def metric_ids(names, metrics: Dict[str, dict]) -> List[int]:
+    """
+    Ids of the metrics in the names collection, registering new ones.
+    """
+    known = _ids[names.full_name]
+    missing = [name for name in metrics if name not in known]
+    if missing:
+        for d in names.find({"name": {"$in": missing}}):
+            known[d["name"]] = d["_id"]
+    for name in metrics:
+        while name not in known:
+            last = list(names.find({}, {"_id": 1}).sort("_id", -1).limit(1))
+            next_id = last[0]["_id"] + 1 if last else 0
+            try:
+                names.insert_one(
+                    {"_id": next_id, "name": name, "group": metrics[name].get("group")}
+                )
+                known[name] = next_id
+            except pymongo.errors.DuplicateKeyError:
+                # Id or name registered concurrently
+                d = names.find_one({"name": name})
+                if d is not None:
+                    known[name] = d["_id"]
+    return [known[name] for name in metrics]
+
+
+def encode(doc: dict, names) -> dict:
+    """
+    Compact version of a document with a metrics dict.
+    """
+    doc = doc.copy()
+    metrics = doc.pop("metrics")
+    ids = numpy.array(metric_ids(names, metrics), dtype=ID_TYPE)
+    values = numpy.array(
+        [m.get("value") for m in metrics.values()], dtype=float
+    ).astype(VALUE_TYPE)
+    doc["schema"] = SCHEMA_VERSION
+    doc["metric_ids"] = Binary(ids.tobytes())
+    doc["values"] = Binary(values.tobytes())
+    return doc
+
+
+def is_compact(entry: dict) -> bool:
+    return entry.get("schema") == SCHEMA_VERSION
+
+
+def load_names(names) -> Dict[int, str]:
+    return {d["_id"]: d["name"] for d in names.find({}, {"name": 1})}
+
+
+def decode_metrics(entry: dict, names: Dict[int, str]) -> Dict[str, dict]:
+    """
+    metrics dict of a compact document, as in a standard document.
+    """
+    ids = numpy.frombuffer(entry["metric_ids"], dtype=ID_TYPE)
+    values = numpy.frombuffer(entry["values"], dtype=VALUE_TYPE)
+    return {
+        names[i]: {"value": None if numpy.isnan(v) else v}
+        for i, v in zip(ids.tolist(), values.tolist())
+    }
+
+
+def frame(entries: List[dict], names: Dict[int, str]) -> pandas.DataFrame:
+    """
+    Dataframe of metric values (one row per compact document, one column
+    per metric) and build_id, built directly from the packed arrays.
+    """
+    ids = [numpy.frombuffer(e["metric_ids"], dtype=ID_TYPE) for e in entries]
+    values = [numpy.frombuffer(e["values"], dtype=VALUE_TYPE) for e in entries]
+    columns, positions = numpy.unique(numpy.concatenate(ids), return_inverse=True)
+    rows = numpy.repeat(numpy.arange(len(entries)), [len(i) for i in ids])
+    data = numpy.full((len(entries), len(columns)), numpy.nan)
+    data[rows, positions] = numpy.concatenate(values)
+    df = pandas.DataFrame(data, columns=[names[i] for i in columns.tolist()])
+    df["build_id"] = [int(e["build_id"] or 0) for e in entries]
+    return df
+
+
+def has_replicates(doc: dict) -> bool:
+    return any(m.get("replicates") for m in doc["metrics"].values())
+
+
+def migrate(col, batch_size=500, drop_replicates=False):
+    """
+    Convert the standard documents of col to the compact schema, which
+    only stores the value of each metric. Documents with replicates are
+    skipped, unless drop_replicates is set. Returns the number of
+    documents converted and skipped.
+    """
+    names = names_collection(col)
+    converted = 0
+    skipped = 0
+    batch = []
+    for doc in col.find({"schema": {"$exists": False}, "metrics": {"$exists": True}}):
+        if not drop_replicates and has_replicates(doc):
+            skipped += 1
+            continue
+        compact = encode(doc, names)
+        batch.append(
+            pymongo.UpdateOne(
+                {"_id": doc["_id"]},
+                {
+                    "$set": {k: compact[k] for k in ("schema", "metric_ids", "values")},
+                    "$unset": {"metrics": ""},
+                },
+            )
+        )
+        if len(batch) >= batch_size:
+            converted += col.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        converted += col.bulk_write(batch, ordered=False).modified_count
+    return converted, skipped
+
+
+if __name__ == "__main__":
+    env = get_env()
+    if env is None:
+        print("Skipping migration (env)")
+        sys.exit(0)
+
+    # --drop-replicates also converts documents with replicates, which
+    # are lost since the compact schema does not store them
+    converted, skipped = migrate(
+        get_collection(env), drop_replicates="--drop-replicates" in sys.argv
+    )
+    print(f"Converted {converted} documents to the compact schema")
+    if skipped:
+        print(
+            f"Skipped {skipped} documents with replicates,"
+            " run with --drop-replicates to convert them without their replicates"
+        )
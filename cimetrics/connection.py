@@ -0,0 +1,36 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import atexit
+import threading
+import pymongo
+from typing import Dict, Tuple
+
+_clients: Dict[Tuple[str, str], pymongo.MongoClient] = {}
+_lock = threading.Lock()
+
+
+def get_client(env) -> pymongo.MongoClient:
+    """
+    MongoClient for the connection string and mongo_options of env,
+    created on first use and shared by all callers in the process.
+    """
+    connection = env.mongo_connection
+    options = env.mongo_options
+    key = (connection, repr(sorted(options.items())))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = pymongo.MongoClient(connection, **options)
+        return _clients[key]
+
+
+def get_collection(env):
+    return get_client(env)[env.mongo_db][env.mongo_collection]
+
+
+@atexit.register
+def close_clients() -> None:
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
@@ -0,0 +1,101 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import numpy
+import pandas
+from typing import Dict, Iterable, List, Optional
+
+# Decimation of long histories before rendering: plotted series are
+# reduced to at most max_plot_points points with Largest-Triangle-
+# Three-Buckets, which keeps the shape of the series, including its
+# spikes, and tables to at most max_table_rows rows, each summarising
+# consecutive builds with their median, min and max.
+
+
+def lttb(x: numpy.ndarray, y: numpy.ndarray, threshold: int) -> numpy.ndarray:
+    """
+    Indexes of the points of (x, y) picked by Largest-Triangle-Three-
+    Buckets: the first and last points, and in each of threshold - 2
+    buckets of points in between, the point forming the largest triangle
+    with the point picked in the previous bucket and the average of the
+    next bucket.
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return numpy.arange(n)
+    every = (n - 2) / (threshold - 2)
+    edges = (numpy.arange(threshold) * every).astype(numpy.intp) + 1
+    edges[-1] = n - 1
+    picked = numpy.empty(threshold, dtype=numpy.intp)
+    picked[0], picked[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < threshold - 1 else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        # Twice the area of the triangles, up to sign
+        areas = numpy.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(numpy.argmax(areas))
+        picked[i + 1] = a
+    return picked
+
+
+def plot_points(
+    df: pandas.DataFrame,
+    max_points: Optional[int],
+    keep: Optional[Dict[str, Iterable[int]]] = None,
+) -> Optional[Dict[str, numpy.ndarray]]:
+    """
+    Positions of the values of each column of df to plot, at most
+    max_points of them, as well as the positions in keep (e.g. those of
+    anomalies). None if df does not need to be decimated.
+    """
+    if not max_points or len(df) <= max_points:
+        return None
+    points = {}
+    x = numpy.arange(len(df))
+    for col in df.columns:
+        y = df[col].to_numpy(dtype=float)
+        finite = numpy.flatnonzero(numpy.isfinite(y))
+        picked = finite[lttb(x[finite], y[finite], max_points)]
+        kept = numpy.array(list((keep or {}).get(col, [])), dtype=numpy.intp)
+        points[col] = numpy.union1d(picked, kept)
+    return points
+
+
+def bucket_table(
+    df: pandas.DataFrame, labels: List[str], max_rows: Optional[int]
+) -> pandas.DataFrame:
+    """
+    Rows of df (with the build number of each in labels), consecutive
+    rows being grouped in at most max_rows buckets. Each bucket is a row
+    with the range of its build numbers, and the median, min and max of
+    each column. df is returned with labels as is if it is short enough.
+    """
+    if not max_rows or len(df) <= max_rows:
+        table = df.copy()
+        table.insert(loc=0, column="build_number", value=labels)
+        return table
+    buckets = numpy.array_split(numpy.arange(len(df)), max_rows)
+    rows = []
+    for bucket in buckets:
+        values = df.iloc[bucket]
+        first, last = bucket[0], bucket[-1]
+        row = {
+            "build_id": f"{df.index[first]}-{df.index[last]}",
+            "build_number": f"{labels[first]}-{labels[last]}",
+        }
+        medians, lows, highs = values.median(), values.min(), values.max()
+        for col in df.columns:
+            if numpy.isnan(medians[col]):
+                row[col] = ""
+            elif lows[col] == highs[col]:
+                row[col] = f"{medians[col]:g}"
+            else:
+                row[col] = f"{medians[col]:g} [{lows[col]:g}, {highs[col]:g}]"
+        rows.append(row)
+    return pandas.DataFrame(rows).set_index("build_id")
@@ -1,13 +1,28 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
-from typing import Optional
+from typing import Dict, List, Optional
 import os
-import yaml
-from git import Repo, exc
+import zlib
+
+_envs: dict = {}
 
 
 def get_env():
+    """
+    Environment for the current directory and environment variables,
+    resolved once and then shared by all callers in the process.
+    """
+    key = (os.getcwd(), frozenset(os.environ.items()))
+    if key not in _envs:
+        _envs[key] = resolve_env()
+    return _envs[key]
+
+
+def resolve_env():
+    # Imported here since GitPython is slow to import
+    from git import Repo, exc
+
     try:
         repo = Repo(os.getcwd(), search_parent_directories=True)
     except exc.InvalidGitRepositoryError:
@@ -20,8 +35,82 @@ def get_env():
         return GitEnv(repo)
 
 
+def peel_loose_object(git_dir: str, sha: str) -> Optional[str]:
+    """
+    Commit sha an object stored as a loose object points to: sha itself
+    for a commit, the tagged commit for an annotated tag. None if the
+    object is not stored loose (i.e. is packed).
+    """
+    path = os.path.join(git_dir, "objects", sha[:2], sha[2:])
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as fp:
+        data = zlib.decompress(fp.read())
+    header, _, body = data.partition(b"\0")
+    if header.startswith(b"commit "):
+        return sha
+    if header.startswith(b"tag ") and body.startswith(b"object "):
+        target = body[len(b"object ") :].split(b"\n", 1)[0].decode()
+        return peel_loose_object(git_dir, target)
+    return None
+
+
+def tags_by_commit(repo) -> Dict[str, List[str]]:
+    """
+    Reverse index of tag names by the commit they point to, built from
+    packed-refs and loose tag refs rather than by resolving each tag.
+    """
+    git_dir = repo.common_dir
+    index: Dict[str, List[str]] = {}
+
+    def add(sha, name):
+        index.setdefault(sha, []).append(name)
+
+    packed_refs = os.path.join(git_dir, "packed-refs")
+    packed = set()
+    if os.path.exists(packed_refs):
+        with open(packed_refs) as fp:
+            # "<sha> refs/tags/<name>" lines, followed by "^<sha>" with
+            # the peeled commit when the tag is annotated
+            name = None
+            for line in fp:
+                line = line.strip()
+                if line.startswith("#") or not line:
+                    continue
+                if line.startswith("^"):
+                    if name is not None:
+                        add(line[1:], name)
+                    continue
+                sha, ref = line.split(" ", 1)
+                name = None
+                if ref.startswith("refs/tags/"):
+                    name = ref[len("refs/tags/") :]
+                    packed.add(name)
+                    add(sha, name)
+
+    tags_dir = os.path.join(git_dir, "refs", "tags")
+    for root, _, files in os.walk(tags_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            name = os.path.relpath(path, tags_dir).replace(os.sep, "/")
+            with open(path) as fp:
+                sha = fp.read().strip()
+            # Loose refs take precedence over packed ones
+            if name in packed:
+                for names in index.values():
+                    if name in names:
+                        names.remove(name)
+            commit = peel_loose_object(git_dir, sha)
+            if commit is None:
+                commit = repo.tag(f"refs/tags/{name}").commit.hexsha
+            add(commit, name)
+    return index
+
+
 class Env(object):
     def __init__(self) -> None:
+        import yaml
+
         root = self.repo_root
         self.CONFIG_FILE = "metrics.yml"
         self.DEFAULT_TARGET_BRANCH = "main"
@@ -76,6 +165,12 @@ class Env(object):
     def mongo_connection(self) -> str:
         return os.environ["METRICS_MONGO_CONNECTION"]
 
+    @property
+    def mongo_options(self) -> dict:
+        # Keyword arguments for pymongo.MongoClient, e.g. maxPoolSize,
+        # connectTimeoutMS, compressors or retryWrites
+        return self.cfg.get("mongo_options", {})
+
     @property
     def build_id(self):
         return None
@@ -96,6 +191,140 @@ class Env(object):
     def monitoring_columns(self) -> int:
         return self.cfg.get("monitoring_columns", 2)
 
+    @property
+    def ensure_indexes(self) -> bool:
+        return self.cfg.get("ensure_indexes", True)
+
+    @property
+    def check_query_plans(self) -> bool:
+        return self.cfg.get("check_query_plans", False)
+
+    @property
+    def history_cache(self) -> bool:
+        return self.cfg.get("history_cache", False)
+
+    @property
+    def history_cache_max_age_days(self) -> float:
+        return self.cfg.get("history_cache_max_age_days", 7)
+
+    @property
+    def history_cache_max_size_mb(self) -> float:
+        return self.cfg.get("history_cache_max_size_mb", 100)
+
+    @property
+    def history_cache_overlap_minutes(self) -> float:
+        return self.cfg.get("history_cache_overlap_minutes", 15)
+
+    @property
+    def upload_buffer_size(self) -> int:
+        return self.cfg.get("upload_buffer_size", 100)
+
+    @property
+    def upload_buffer_seconds(self) -> float:
+        return self.cfg.get("upload_buffer_seconds", 5.0)
+
+    @property
+    def upload_queue_size(self) -> int:
+        return self.cfg.get("upload_queue_size", 1000)
+
+    @property
+    def upload_queue_policy(self) -> str:
+        return self.cfg.get("upload_queue_policy", "block")
+
+    @property
+    def upload_retries(self) -> int:
+        return self.cfg.get("upload_retries", 5)
+
+    @property
+    def upload_retry_backoff(self) -> float:
+        return self.cfg.get("upload_retry_backoff", 0.5)
+
+    @property
+    def plot_format(self) -> str:
+        # "png" (diff.png), "html" (diff.html, see cimetrics.report) or "both"
+        return self.cfg.get("plot_format", "png")
+
+    @property
+    def png_colors(self) -> Optional[int]:
+        return self.cfg.get("png_colors")
+
+    @property
+    def png_compress_level(self) -> int:
+        return self.cfg.get("png_compress_level", 6)
+
+    @property
+    def image_storage(self) -> str:
+        # "azure" (AZURE_BLOB_URL and AZURE_WEB_URL) or "local"
+        return self.cfg.get("image_storage", "azure")
+
+    @property
+    def image_storage_path(self) -> str:
+        return self.cfg.get("image_storage_path", "_cimetrics/images")
+
+    @property
+    def comment_images(self) -> str:
+        # "groups" (one image per group) or "stacked" (diff.png)
+        return self.cfg.get("comment_images", "groups")
+
+    @property
+    def image_upload_workers(self) -> int:
+        return self.cfg.get("image_upload_workers", 4)
+
+    @property
+    def max_plot_points(self) -> Optional[int]:
+        return self.cfg.get("max_plot_points")
+
+    @property
+    def max_table_rows(self) -> Optional[int]:
+        return self.cfg.get("max_table_rows")
+
+    @property
+    def plot_workers(self) -> int:
+        return self.cfg.get("plot_workers", 1)
+
+    @property
+    def batch_branches(self) -> List[str]:
+        return self.cfg.get("batch_branches", [])
+
+    @property
+    def batch_max_age_days(self) -> float:
+        return self.cfg.get("batch_max_age_days", 14)
+
+    @property
+    def document_schema(self) -> str:
+        # "standard" or "compact", see cimetrics.compact
+        return self.cfg.get("document_schema", "standard")
+
+    @property
+    def anomaly_detector(self) -> str:
+        # "builtin" or "adtk", see cimetrics.anomaly
+        return self.cfg.get("anomaly_detector", "builtin")
+
+    @property
+    def anomaly_state(self) -> bool:
+        return self.cfg.get("anomaly_state", False)
+
+    @property
+    def significance_test(self) -> bool:
+        return self.cfg.get("significance_test", False)
+
+    @property
+    def significance_builds(self) -> int:
+        return self.cfg.get("significance_builds", 20)
+
+    @property
+    def significance_level(self) -> float:
+        return self.cfg.get("significance_level", 0.05)
+
+    @property
+    def rollups(self) -> bool:
+        return self.cfg.get("rollups", False)
+
+    @property
+    def thresholds(self) -> dict:
+        # Regression allowed for the metrics of each group, in percent
+        return self.cfg.get("thresholds", {})
+
     @property
     def groups(self) -> dict:
         return self.cfg.get("groups", {"Metrics": ".*"})
@@ -103,28 +332,42 @@ class Env(object):
 
 class GitEnv(Env):
     _target_branch = None
+    _commit = None
+    _branch = None
+    _branch_resolved = False
 
     def __init__(self, repo) -> None:
         self.repo = repo
+        self._repo_root = repo.working_tree_dir
         super().__init__()
 
     @property
     def repo_root(self) -> str:
-        return self.repo.working_tree_dir
+        return self._repo_root
 
     @property
     def branch(self) -> Optional[str]:
-        if not self.repo.head.is_detached:
-            return self.repo.active_branch.name
-        tag_or_none = next(
-            (tag.name for tag in self.repo.tags if tag.commit == self.repo.head.commit),
-            None,
-        )
-        return tag_or_none
+        if not self._branch_resolved:
+            if not self.repo.head.is_detached:
+                self._branch = self.repo.active_branch.name
+            else:
+                tags = tags_by_commit(self.repo).get(self.commit, [])
+                self._branch = min(tags) if tags else None
+            self._branch_resolved = True
+        return self._branch
 
     @property
     def commit(self) -> str:
-        return self.repo.commit().hexsha
+        if self._commit is None:
+            self._commit = self.repo.commit().hexsha
+        return self._commit
+
+    def commits(self, rev_range: str) -> List[str]:
+        """
+        Hashes of the commits of rev_range (e.g. "v1.0..v1.1"), as listed
+        by git log, to select builds with Metrics.range_history().
+        """
+        return [c.hexsha for c in self.repo.iter_commits(rev_range)]
 
     @property
     def target_branch(self) -> str:
@@ -4,19 +4,61 @@
 import requests
 import json
 import sys
-import base64
+import time
 import datetime
 import os
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 
 from cimetrics.env import get_env
+from cimetrics.storage import content_name, get_storage
 
 # Always the same for metrics-devops
 IMAGE_PATH = "_cimetrics/diff.png"
+REPORT_PATH = "_cimetrics/diff.html"
 COMMENT_PATH = "_cimetrics/diff.txt"
+PLOTS_PATH = "_cimetrics/plots.json"
+# Id of the published comment and ETags of the pages of comments,
+# kept between runs
+STATE_PATH = "_cimetrics/github.json"
+
+# Retries of requests failing with a server error, and of requests
+# rate limited for at most MAX_RATE_LIMIT_WAIT seconds
+RETRIES = 5
+RATE_LIMIT_RETRIES = 3
+MAX_RATE_LIMIT_WAIT = 60
 
 AZURE_BLOB_URL = os.getenv("AZURE_BLOB_URL")
 AZURE_WEB_URL = os.getenv("AZURE_WEB_URL")
+AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+
+
+def github_session(token):
+    """
+    Session reusing connections to the GitHub API, and retrying requests
+    with exponential backoff on server errors. Comments are only created
+    once, so POST requests are not retried once sent.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "PATCH"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(
+        {
+            "content-type": "application/json",
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"token {token}",
+        }
+    )
+    return session
 
 
 class GithubPRPublisher(object):
@@ -25,59 +67,174 @@ class GithubPRPublisher(object):
         if self.env is None:
             return
 
-        self.request_header = {
-            "content-type": "application/json",
-            "Authorization": f"token {self.env.github_token}",
-        }
+        self.session = github_session(self.env.github_token)
         self.github_url = f"https://api.github.com/repos/{self.env.repo_id}"
         self.pull_request_id = self.env.pull_request_id
+        self.state_path = os.path.join(self.env.repo_root, STATE_PATH)
+        self.state = self.load_state()
+        self.storage = get_storage(self.env)
 
-    def upload_image_as_blob(self, contents):
-        service = BlobServiceClient(account_url=AZURE_BLOB_URL)
-        name = f"plot-{self.env.repo_name.replace('/', '-')}-{self.env.pull_request_id}.png"
-        blob = service.get_blob_client(container="$web", blob=name)
-        blob.upload_blob(
-            contents,
-            overwrite=True,
-            content_settings=ContentSettings(
-                content_type="image/png", cache_control="no-cache"
-            ),
-        )
-        return f"{AZURE_WEB_URL}/{name}"
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        if state.get("pull_request_id") != self.pull_request_id:
+            state = {"pull_request_id": self.pull_request_id}
+        return state
 
-    def first_self_comment(self):
-        rep = requests.get(
-            f"{self.github_url}/issues/{self.pull_request_id}/comments",
-            headers=self.request_header,
-        )
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, "w") as f:
+            json.dump(self.state, f)
 
-        for comment in rep.json():
-            login = comment.get("user", {}).get("login")
-            if login == self.env.pr_user:
-                return comment["id"]
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, waiting and retrying when rate limited. Server
+        errors are retried by the session.
+        """
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            rep = self.session.request(method, url, **kwargs)
+            if rep.status_code not in (403, 429) or attempt == RATE_LIMIT_RETRIES:
+                return rep
+            if "Retry-After" in rep.headers:
+                delay = float(rep.headers["Retry-After"])
+            elif rep.headers.get("X-RateLimit-Remaining") == "0":
+                delay = float(rep.headers.get("X-RateLimit-Reset", 0)) - time.time()
+            else:
+                return rep
+            if delay > MAX_RATE_LIMIT_WAIT:
+                return rep
+            print(f"Rate limited by GitHub, retrying in {max(delay, 0):.0f}s")
+            time.sleep(max(delay, 0))
+        return rep
+
+    def upload_image_as_blob(self, contents, extension="png", content_type="image/png"):
+        """
+        Upload an image (or another file) under a name derived from its
+        contents, unless it has already been uploaded (e.g. by a previous
+        build of the pull request, if that plot has not changed). Returns
+        its URL, and whether it was uploaded.
+        """
+        name = content_name(contents, extension)
+        if self.storage.exists(name):
+            return self.storage.url(name), False
+        self.storage.upload(name, contents, content_type)
+        return self.storage.url(name), True
+
+    def upload_report(self, path):
+        """
+        Upload the HTML report of path, and return its URL.
+        """
+        with open(path, "rb") as report_file:
+            url, _ = self.upload_image_as_blob(
+                report_file.read(), "html", "text/html; charset=utf-8"
+            )
+        return url
+
+    def upload_images(self, paths):
+        """
+        Upload the images of paths in parallel, and return their URLs.
+        """
+
+        def upload(path):
+            with open(path, "rb") as image_file:
+                return self.upload_image_as_blob(image_file.read())
+
+        with ThreadPoolExecutor(self.env.image_upload_workers) as executor:
+            results = list(executor.map(upload, paths))
+        uploaded = sum(1 for _, new in results if new)
+        print(f"Uploaded {uploaded} images, {len(results) - uploaded} already uploaded")
+        return [url for url, _ in results]
+
+    def comment_pages(self):
+        """
+        Comments of the pull request (id and author), page by page. Pages
+        that have not changed since they were last read are taken from
+        the state, using conditional requests that do not count against
+        the rate limit.
+        """
+        pages = self.state.setdefault("pages", {})
+        url = f"{self.github_url}/issues/{self.pull_request_id}/comments?per_page=100"
+        while url:
+            cached = pages.get(url)
+            headers = {"If-None-Match": cached["etag"]} if cached else {}
+            rep = self.request("GET", url, headers=headers)
+            if rep.status_code == 304:
+                comments, next_url = cached["comments"], cached["next"]
+            else:
+                rep.raise_for_status()
+                comments = [
+                    {"id": c["id"], "login": c.get("user", {}).get("login")}
+                    for c in rep.json()
+                ]
+                next_url = rep.links.get("next", {}).get("url")
+                if "ETag" in rep.headers:
+                    pages[url] = {
+                        "etag": rep.headers["ETag"],
+                        "comments": comments,
+                        "next": next_url,
+                    }
+            yield comments
+            url = next_url
+
+    def first_self_comment(self):
+        for comments in self.comment_pages():
+            for comment in comments:
+                if comment["login"] == self.env.pr_user:
+                    return comment["id"]
         return None
 
-    def publish_comment(self, image_report_url, comment):
+    def publish_comment(self, images, comment, links=()):
+        """
+        Publish comment, followed by links and images, lists of
+        (title, URL).
+        """
         params = {}
-        params["body"] = f"{comment}\n![images]({image_report_url})"
+        params["body"] = "\n".join(
+            [comment]
+            + [f"[{title}]({url})" for title, url in links]
+            + [f"![{title}]({url})" for title, url in images]
+        )
+        data = json.dumps(params)
+
+        # Usually a single request, updating the comment published by
+        # a previous run
+        comment_id = self.state.get("comment_id")
+        if comment_id is not None:
+            print(
+                f"Updating comment {comment_id} on pull request {self.pull_request_id}"
+            )
+            rep = self.request(
+                "PATCH", f"{self.github_url}/issues/comments/{comment_id}", data=data
+            )
+            if rep.status_code != 404:
+                rep.raise_for_status()
+                return
+            # The comment has been deleted
+            del self.state["comment_id"]
 
         comment_id = self.first_self_comment()
         if comment_id is None:
             print(f"Publishing comment to pull request {self.pull_request_id}")
-            rep = requests.post(
+            rep = self.request(
+                "POST",
                 f"{self.github_url}/issues/{self.pull_request_id}/comments",
-                data=json.dumps(params),
-                headers=self.request_header,
+                data=data,
             )
+            rep.raise_for_status()
+            comment_id = rep.json()["id"]
         else:
             print(
                 f"Updating comment {comment_id} on pull request {self.pull_request_id}"
             )
-            rep = requests.patch(
-                f"{self.github_url}/issues/comments/{comment_id}",
-                data=json.dumps(params),
-                headers=self.request_header,
+            rep = self.request(
+                "PATCH", f"{self.github_url}/issues/comments/{comment_id}", data=data
             )
+            rep.raise_for_status()
+        self.state["comment_id"] = comment_id
+        self.save_state()
 
 
 if __name__ == "__main__":
@@ -86,19 +243,40 @@ if __name__ == "__main__":
         print("Skipping publishing of PR comment (env)")
         sys.exit(0)
 
+    if env.image_storage == "azure":
+        assert AZURE_STORAGE_CONNECTION_STRING or (
+            AZURE_BLOB_URL and AZURE_WEB_URL
+        ), "Either AZURE_BLOB_URL or AZURE_WEB_URL is not set"
     publisher = GithubPRPublisher()
 
-    encoded_image = None
-    raw_image = None
-    with open(os.path.join(env.repo_root, IMAGE_PATH), "rb") as image_file:
-        raw_image = image_file.read()
-        encoded_image = base64.b64encode(raw_image)
     comment = ""
     with open(os.path.join(env.repo_root, COMMENT_PATH), "r") as comment_file:
         comment = comment_file.read()
 
-    assert (
-        AZURE_BLOB_URL and AZURE_WEB_URL
-    ), "Either AZURE_BLOB_URL or AZURE_WEB_URL is not set"
-    image_url = publisher.upload_image_as_blob(raw_image)
-    publisher.publish_comment(image_url, comment)
+    # One image per group when the plots of the groups are available,
+    # so that only the plots that changed since the last build are
+    # uploaded. Otherwise, the stacked image, unless only the HTML
+    # report was written (plot_format: html).
+    plots_path = os.path.join(env.repo_root, PLOTS_PATH)
+    image_path = os.path.join(env.repo_root, IMAGE_PATH)
+    report_path = os.path.join(env.repo_root, REPORT_PATH)
+    if env.comment_images == "groups" and os.path.exists(plots_path):
+        with open(plots_path) as f:
+            plots = json.load(f)
+        titles = [plot["group"] for plot in plots]
+        paths = [
+            os.path.join(os.path.dirname(plots_path), plot["path"]) for plot in plots
+        ]
+    elif os.path.exists(image_path):
+        titles = ["images"]
+        paths = [image_path]
+    else:
+        titles, paths = [], []
+    if not paths and not os.path.exists(report_path):
+        # Plotted with --no-plot, or without any metric
+        print(f"Neither {image_path} nor {report_path} exist, publishing text only")
+    image_urls = publisher.upload_images(paths) if paths else []
+    links = []
+    if os.path.exists(report_path):
+        links.append(("Interactive report", publisher.upload_report(report_path)))
+    publisher.publish_comment(list(zip(titles, image_urls)), comment, links)
@@ -0,0 +1,78 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import sys
+import argparse
+import datetime
+
+from cimetrics.env import get_env
+from cimetrics.plot import Metrics
+
+# Export of the history of a branch over a date window and/or a range
+# of commits, e.g. to bisect a regression, without reading the whole
+# collection:
+#
+#   python -m cimetrics.history --since 2021-01-01 --until 2021-04-01
+#   python -m cimetrics.history --commits v1.0..v1.1 --branch release/1.x
+
+OUTPUT_PATH = "_cimetrics/history.csv"
+
+
+def parse_args(argv, env):
+    parser = argparse.ArgumentParser(prog="python -m cimetrics.history")
+    parser.add_argument(
+        "--branch",
+        default=None,
+        help=f"Branch to read (default: the target branch, {env.target_branch})",
+    )
+    parser.add_argument(
+        "--since",
+        type=datetime.datetime.fromisoformat,
+        help="Only builds created at or after this date (ISO format)",
+    )
+    parser.add_argument(
+        "--until",
+        type=datetime.datetime.fromisoformat,
+        help="Only builds created before this date (ISO format)",
+    )
+    parser.add_argument(
+        "--commits",
+        help="Only builds of the commits of this range, e.g. v1.0..v1.1",
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join(env.repo_root, OUTPUT_PATH),
+        help="CSV file to write (default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    env = get_env()
+    if env is None:
+        print("Skipping history export (env)")
+        sys.exit(0)
+
+    args = parse_args(sys.argv[1:], env)
+    try:
+        m = Metrics(env)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    branch = args.branch or env.target_branch
+    commits = env.commits(args.commits) if args.commits else None
+    history, builds = m.range_history(
+        {"branch": branch}, args.since, args.until, commits
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    # Joined by position, since builds may have been created at the same time
+    table = builds.reset_index().join(history.reset_index(drop=True))
+    table.set_index("created").to_csv(args.output)
+    if len(history):
+        print(
+            f"{len(history)} builds of {branch} from {history.index[0]}"
+            f" to {history.index[-1]} written to {args.output}"
+        )
+    else:
+        print(f"No builds of {branch} found")
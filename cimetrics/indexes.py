@@ -0,0 +1,226 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import sys
+import datetime
+import pymongo
+
+from cimetrics.env import get_env
+from cimetrics.connection import get_collection
+
+# Indexes backing the history lookups done when plotting
+INDEXES = {
+    "branch_created": [("branch", pymongo.ASCENDING), ("created", pymongo.DESCENDING)],
+    "pr_id_created": [("pr_id", pymongo.ASCENDING), ("created", pymongo.DESCENDING)],
+    "branch_build_id": [("branch", pymongo.ASCENDING), ("build_id", pymongo.ASCENDING)],
+    "pr_id_build_id": [("pr_id", pymongo.ASCENDING), ("build_id", pymongo.ASCENDING)],
+    # Documents of the selected builds, joined by the history aggregation
+    "build_id": [("build_id", pymongo.ASCENDING)],
+    # Builds of a range of commits, see Metrics.range_history
+    "branch_commit": [("branch", pymongo.ASCENDING), ("commit", pymongo.ASCENDING)],
+    # Recent builds, listed by batch plotting
+    "created": [("created", pymongo.DESCENDING)],
+}
+
+
+def ensure_indexes(col):
+    """
+    Create the indexes in INDEXES on col. Creating an index that
+    already exists with the same name and keys is a no-op.
+    """
+    try:
+        for name, keys in INDEXES.items():
+            col.create_index(keys, name=name)
+    except pymongo.errors.OperationFailure as e:
+        print(f"Could not create indexes on {col.name}: {e}")
+
+
+def plan_stages(plan):
+    """
+    All stage names in a (possibly nested) query plan.
+    """
+    stages = [plan.get("stage")]
+    for child in plan.get("inputStages", []) + [plan.get("inputStage", {})]:
+        if child:
+            stages += plan_stages(child)
+    return stages
+
+
+def winning_plans(explain):
+    """
+    Winning plans of all the queries in the explain output of a find
+    or an aggregation, e.g. of the $cursor stage of a pipeline, or of
+    each shard.
+    """
+    plans = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan":
+                # Slot-based plans nest the query plan
+                plans.append(value.get("queryPlan", value))
+            else:
+                plans += winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            plans += winning_plans(value)
+    return plans
+
+
+def unindexed_lookups(plan):
+    """
+    Foreign collections scanned by the $lookup stages pushed down into
+    a (possibly nested) query plan.
+    """
+    lookups = []
+    if plan.get("stage") == "EQ_LOOKUP" and plan.get("strategy") == "NestedLoopJoin":
+        lookups.append(plan.get("foreignCollection"))
+    for child in plan.get("inputStages", []) + [plan.get("inputStage", {})]:
+        if child:
+            lookups += unindexed_lookups(child)
+    return lookups
+
+
+def history_pipeline(collection, branch_query, max_build_id, max_builds, fields):
+    """
+    Aggregation issued by plot.Metrics.branch_history in a single round
+    trip: select the last max_builds build ids (by descending created
+    timestamp), up to max_build_id if specified, grouping only the build
+    id and created timestamp of the matching documents, then join the
+    fields of the documents of those builds from collection.
+    """
+    query = branch_query.copy()
+    query["build_id"] = {"$nin": [None, ""]}
+    pipeline = [
+        {"$match": query},
+        # Served by the branch_created and pr_id_created indexes
+        {"$sort": {"created": pymongo.DESCENDING}},
+        {
+            "$project": {
+                "_build_id": {"$toLong": "$build_id"},
+                "build_id": 1,
+                "created": 1,
+            }
+        },
+    ]
+    if max_build_id is not None:
+        pipeline.append({"$match": {"_build_id": {"$lte": int(max_build_id)}}})
+    pipeline += [
+        {
+            "$group": {
+                "_id": "$_build_id",
+                "created": {"$max": "$created"},
+                # Build ids as stored, as strings or numbers
+                "build_ids": {"$addToSet": "$build_id"},
+            }
+        },
+        {"$sort": {"created": pymongo.DESCENDING}},
+        {"$limit": max_builds},
+        {
+            # Served by the build_id index
+            "$lookup": {
+                "from": collection,
+                "localField": "build_ids",
+                "foreignField": "build_id",
+                "as": "entries",
+            }
+        },
+        {"$unwind": "$entries"},
+        {"$replaceRoot": {"newRoot": "$entries"}},
+        # Documents of the same build ids on other branches
+        {"$match": branch_query},
+        {"$project": {field: 1 for field in fields}},
+    ]
+    return pipeline
+
+
+def history_queries(branch_query):
+    """
+    Queries issued by plot.Metrics.branch_history for branch_query,
+    as (filter, sort) pairs.
+    """
+    by_build_id = branch_query.copy()
+    by_build_id["build_id"] = {"$in": []}
+    return [
+        (branch_query, [("created", pymongo.DESCENDING)]),
+        (by_build_id, [("build_id", pymongo.ASCENDING)]),
+    ]
+
+
+def range_queries(branch_query):
+    """
+    Queries issued by plot.Metrics.range_history for branch_query, by
+    date window and by commits, as (filter, sort) pairs.
+    """
+    by_created = branch_query.copy()
+    by_created["created"] = {"$gte": datetime.datetime(1970, 1, 1)}
+    by_commit = branch_query.copy()
+    by_commit["commit"] = {"$in": []}
+    return [
+        (by_created, [("created", pymongo.ASCENDING)]),
+        (by_commit, [("created", pymongo.ASCENDING)]),
+    ]
+
+
+def check_query_plans(col, queries, pipelines=()):
+    """
+    Explain each (filter, sort) query and each aggregation pipeline,
+    and warn about those resolved with a collection scan. Returns the
+    number of queries and pipelines not using an index.
+    """
+    unindexed = 0
+    for query, sort in queries:
+        try:
+            explain = col.find(query).sort(sort).explain()
+        except (pymongo.errors.OperationFailure, NotImplementedError) as e:
+            print(f"Could not explain query {query}: {e}")
+            continue
+        plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in plan_stages(plan):
+            print(f"WARNING: query {query} sorted by {sort} is not using an index")
+            unindexed += 1
+    for pipeline in pipelines:
+        try:
+            explain = col.database.command(
+                {"aggregate": col.name, "pipeline": pipeline, "explain": True}
+            )
+        except (pymongo.errors.OperationFailure, NotImplementedError) as e:
+            print(f"Could not explain pipeline {pipeline[0]}: {e}")
+            continue
+        plans = winning_plans(explain)
+        lookups = [c for plan in plans for c in unindexed_lookups(plan)]
+        if any("COLLSCAN" in plan_stages(plan) for plan in plans):
+            print(f"WARNING: pipeline {pipeline[0]} is not using an index")
+            unindexed += 1
+        elif lookups:
+            print(
+                f"WARNING: pipeline {pipeline[0]} joins {', '.join(lookups)}"
+                " without an index"
+            )
+            unindexed += 1
+    return unindexed
+
+
+def ensure_and_check(env):
+    """
+    Apply INDEXES to the configured collection and check the plans of
+    the history queries used when plotting.
+    """
+    col = get_collection(env)
+    ensure_indexes(col)
+    queries = history_queries({"branch": env.target_branch})
+    queries += history_queries({"pr_id": "0"})
+    queries += range_queries({"branch": env.target_branch})
+    pipelines = [
+        history_pipeline(col.name, query, None, env.span, ["build_id"])
+        for query in ({"branch": env.target_branch}, {"pr_id": "0"})
+    ]
+    return check_query_plans(col, queries, pipelines)
+
+
+if __name__ == "__main__":
+    env = get_env()
+    if env is None:
+        print("Skipping index creation (env)")
+        sys.exit(0)
+
+    sys.exit(1 if ensure_and_check(env) else 0)
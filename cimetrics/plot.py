@@ -5,18 +5,26 @@ import pymongo
 import pandas
 import os
 import sys
-import matplotlib
-import matplotlib.pyplot as plt
-import sys
+import json
 import math
-import matplotlib.ticker as mtick
-from adtk.detector import LevelShiftAD
+import datetime
+from concurrent.futures import ProcessPoolExecutor
 import re
 
 from cimetrics.env import get_env
-from cimetrics.stack import stack_vertically
-
-plt.style.use("ggplot")
+from cimetrics.cache import HistoryCache
+from cimetrics import compact
+from cimetrics.rollup import read_rollup
+from cimetrics.anomaly import anomalies, incremental_anomalies
+from cimetrics.stats import compare
+from cimetrics.decimate import plot_points, bucket_table
+from cimetrics.connection import get_client
+from cimetrics.indexes import (
+    ensure_indexes,
+    check_query_plans,
+    history_queries,
+    history_pipeline,
+)
 
 
 class Color:
@@ -28,32 +36,16 @@ class Color:
     BACKGROUND = "white"
 
 
-def ticklabel_format(value):
-    """
-    Pick formatter for ytick labels. If possible, just print out the
-    value with the same precision as the branch value. If that doesn't
-    fit, switch to scientific format.
-    """
-    bvs = str(value)
-    if len(bvs) < 7:
-        fp = len(bvs) - (bvs.index(".") + 1) if "." in bvs else 0
-        return f"{{value:.{fp}f}}"
-    else:
-        return "{value:.1e}"
-
-
-def make_ticklabel_formatter(value, match_value=None, append=None):
-    def ticklabel_formatter(val, _):
-        rv = ticklabel_format(value).format(value=val)
-        if match_value is not None and val == match_value:
-            rv = f"{rv}\n({append})"
-        return rv
-
-    return ticklabel_formatter
-
-
-def fancy_date(ds):
-    return f"$_{{{ds[:4]}}}${ds[4:]}"
+# Document fields used to build histories, for standard and compact documents
+HISTORY_FIELDS = [
+    "build_id",
+    "build_number",
+    "created",
+    "metrics",
+    "schema",
+    "metric_ids",
+    "values",
+]
 
 
 class Metrics(object):
@@ -70,7 +62,7 @@ class Metrics(object):
             )
             return
 
-        self.client = pymongo.MongoClient(env.mongo_connection)
+        self.client = get_client(env)
 
         db = None
         self.col = None
@@ -83,25 +75,33 @@ class Metrics(object):
                 f" Make sure you create the {env.config_file} file at the root of your repo."
             )
 
-    def branch_history(self, branch_query, max_build_id=None, max_builds=5):
+        if env.ensure_indexes:
+            ensure_indexes(self.col)
+
+        self.names = None
+        self.cache = None
+        if env.history_cache:
+            self.cache = HistoryCache(
+                os.path.join(env.repo_root, "_cimetrics"),
+                env.history_cache_max_age_days,
+                env.history_cache_max_size_mb,
+                env.history_cache_overlap_minutes,
+            )
+
+    def _aggregate_history(self, branch_query, max_build_id, max_builds):
         """
-        Branch history as a dataframe, up to max_build_id, going back
-        at most max_builds.
+        Single round trip, see indexes.history_pipeline.
         """
+        pipeline = history_pipeline(
+            self.col.name, branch_query, max_build_id, max_builds, HISTORY_FIELDS
+        )
+        return list(self.col.aggregate(pipeline))
 
-        id_to_number = {}
-
-        def flatten(entry):
-            """
-            Flatten an entry from the DB to a dict of metric: value,
-            and numerical build_id
-            """
-            v = {k: v.get("value") for k, v in entry["metrics"].items()}
-            bid = int(entry["build_id"] or 0)
-            v["build_id"] = bid
-            id_to_number[bid] = entry.get("build_number", str(bid))
-            return v
-
+    def _find_history(self, branch_query, max_build_id, max_builds):
+        """
+        Two queries: discover build ids client-side, then fetch their
+        metrics. Used when the server does not support aggregation.
+        """
         # Discover build ids by descending order of created timestamp
         records = self.col.find(branch_query, {"build_id": 1, "created": 1}).sort(
             [("created", pymongo.DESCENDING)]
@@ -124,35 +124,203 @@ class Metrics(object):
         # Get metrics for those build ids, ordered by build_ids
         query = branch_query.copy()
         query["build_id"] = {"$in": list(build_ids)}
-        records = self.col.find(
-            query, {"build_id": 1, "metrics": 1, "build_number": 1}
-        ).sort([("build_id", pymongo.ASCENDING)])
+        return self.col.find(query, {field: 1 for field in HISTORY_FIELDS}).sort(
+            [("build_id", pymongo.ASCENDING)]
+        )
+
+    def _fetch_history(self, branch_query, max_build_id, max_builds):
+        try:
+            return self._aggregate_history(branch_query, max_build_id, max_builds)
+        except pymongo.errors.OperationFailure as e:
+            print(f"Aggregation not supported ({e}), falling back to find queries")
+            return self._find_history(branch_query, max_build_id, max_builds)
+
+    def _cached_history(self, branch_query, max_build_id, max_builds):
+        """
+        Refresh the cached history for branch_query with documents
+        created since the last refresh (see HistoryCache.high_water_mark),
+        and read it back from the cache.
+        """
+        self.cache.evict()
+        key = self.cache.key(self.col, branch_query)
+        since = self.cache.high_water_mark(key, max_builds)
+        if since is None:
+            records = self._fetch_history(branch_query, max_build_id, max_builds)
+        else:
+            query = branch_query.copy()
+            query["created"] = {"$gte": since}
+            records = self.col.find(query, {field: 1 for field in HISTORY_FIELDS})
+        records = [self._standard(r) for r in records]
+        self.cache.store(key, max_builds, records)
+        return self.cache.history(key, max_build_id, max_builds)
+
+    def metric_names(self, refresh=False):
+        """
+        Metric names by id, for compact documents.
+        """
+        if self.names is None or refresh:
+            self.names = compact.load_names(compact.names_collection(self.col))
+        return self.names
+
+    def _standard(self, entry):
+        if not compact.is_compact(entry):
+            return entry
+        try:
+            metrics = compact.decode_metrics(entry, self.metric_names())
+        except KeyError:
+            metrics = compact.decode_metrics(entry, self.metric_names(refresh=True))
+        return dict(entry, metrics=metrics)
+
+    def _compact_frame(self, entries):
+        try:
+            return compact.frame(entries, self.metric_names())
+        except KeyError:
+            return compact.frame(entries, self.metric_names(refresh=True))
+
+    def _history_frame(self, records, replicates=False):
+        """
+        Metrics of records (documents from the DB) as a dataframe indexed
+        by numerical build_id, keeping only complete builds, and build
+        numbers by build_id. If replicates is set, also return the values
+        of all replicates of each build, one row per replicate (from
+        put_replicates() or from several documents).
+        """
+
+        id_to_number = {}
+
+        def flatten(entry):
+            """
+            Flatten an entry from the DB to a dict of metric: value,
+            and numerical build_id
+            """
+            v = {k: v.get("value") for k, v in entry["metrics"].items()}
+            bid = int(entry["build_id"] or 0)
+            v["build_id"] = bid
+            id_to_number[bid] = entry.get("build_number", str(bid))
+            return v
+
+        def expand(entry):
+            """
+            Rows of metric: value for each replicate of an entry from
+            the DB, and numerical build_id
+            """
+            metrics = entry["metrics"]
+            count = max(
+                [len(v.get("replicates") or [None]) for v in metrics.values()] or [1]
+            )
+            rows = [{"build_id": int(entry["build_id"] or 0)} for _ in range(count)]
+            for k, v in metrics.items():
+                for row, value in zip(rows, v.get("replicates") or [v.get("value")]):
+                    row[k] = value
+            return rows
+
+        # Standard documents are flattened, compact documents are read
+        # from their arrays
+        standard, compact_entries, rows = [], [], []
+        for r in records:
+            if compact.is_compact(r):
+                bid = int(r["build_id"] or 0)
+                id_to_number[bid] = r.get("build_number", str(bid))
+                compact_entries.append(r)
+            else:
+                standard.append(flatten(r))
+                if replicates:
+                    rows += expand(r)
+        frames, replicate_frames = [], []
+        if standard or not compact_entries:
+            frames.append(pandas.DataFrame.from_records(standard))
+            replicate_frames.append(pandas.DataFrame.from_records(rows))
+        if compact_entries:
+            frames.append(self._compact_frame(compact_entries))
+            replicate_frames.append(frames[-1])
 
         # Index and collapse metrics by build_id
-        df = (
-            pandas.DataFrame.from_records([flatten(r) for r in records])
-            .set_index("build_id")
-            .groupby("build_id")
-            .mean()
-        )
+        df = pandas.concat(frames).set_index("build_id").groupby("build_id").mean()
         # Drop incomplete rows
         if "__complete" in df.columns:
             df = df.dropna(subset=["__complete"])
             df = df.drop(columns=["__complete"])
+        if replicates:
+            reps = pandas.concat(replicate_frames).set_index("build_id")
+            return df, id_to_number, reps[reps.index.isin(df.index)]
+        return df, id_to_number
+
+    def branch_history(
+        self, branch_query, max_build_id=None, max_builds=5, replicates=False
+    ):
+        """
+        Branch history as a dataframe, up to max_build_id, going back
+        at most max_builds. If replicates is set, also return the values
+        of all replicates of each build, one row per replicate (from
+        put_replicates() or from several documents).
+        """
+        if self.cache is None:
+            records = self._fetch_history(branch_query, max_build_id, max_builds)
+        else:
+            records = self._cached_history(branch_query, max_build_id, max_builds)
+
+        if replicates:
+            df, id_to_number, reps = self._history_frame(records, replicates=True)
+        else:
+            df, id_to_number = self._history_frame(records)
         # Drop columns for metrics that don't exist in the last build
         df = df[list(df.tail(1).dropna(axis="columns", how="all"))]
+        if replicates:
+            return df, id_to_number, reps.reindex(columns=df.columns)
         return df, id_to_number
 
+    def range_history(self, branch_query, since=None, until=None, commits=None):
+        """
+        Branch history of the builds created in [since, until), of the
+        given commits if specified (see GitEnv.commits()), as a dataframe
+        indexed by the creation time of each build (a DatetimeIndex). Also
+        returns the build id, build number and commit of each build, with
+        the same index. Both are ordered by creation time.
+        """
+        query = branch_query.copy()
+        query["build_id"] = {"$nin": [None, ""]}
+        created = {}
+        if since is not None:
+            created["$gte"] = since
+        if until is not None:
+            created["$lt"] = until
+        if created:
+            query["created"] = created
+        if commits is not None:
+            query["commit"] = {"$in": list(commits)}
+        records = list(
+            self.col.find(
+                query, {field: 1 for field in HISTORY_FIELDS + ["commit"]}
+            ).sort([("created", pymongo.ASCENDING)])
+        )
+        if not records:
+            index = pandas.DatetimeIndex([], name="created")
+            builds = pandas.DataFrame(
+                columns=["build_id", "build_number", "commit"], index=index
+            )
+            return pandas.DataFrame(index=index), builds
 
-def anomalies(series, window_size):
-    try:
-        ts = series.set_index(pandas.date_range(start="1/1/1970", periods=len(series)))
-        ad = LevelShiftAD(window=window_size, c=3)
-        an = ad.fit_detect(ts).fillna(0).diff().fillna(0).reset_index(drop=True)
-        return an[an > 0].dropna().index
-    except RuntimeError as err:
-        print(f"Could not detect anomalies: {err}")
-        return []
+        df, id_to_number = self._history_frame(records)
+        # A build is dated by its last document
+        build_created, build_commit = {}, {}
+        for r in records:
+            bid = int(r["build_id"] or 0)
+            build_created[bid] = max(r["created"], build_created.get(bid, r["created"]))
+            build_commit[bid] = r.get("commit")
+        build_ids = df.index
+        df.index = pandas.DatetimeIndex(
+            [build_created[b] for b in build_ids], name="created"
+        )
+        builds = pandas.DataFrame(
+            {
+                "build_id": build_ids,
+                "build_number": [id_to_number[b] for b in build_ids],
+                "commit": [build_commit[b] for b in build_ids],
+            },
+            index=df.index,
+        )
+        order = df.index.argsort(kind="stable")
+        return df.iloc[order], builds.iloc[order]
 
 
 def column_mapping(env, columns):
@@ -170,37 +338,199 @@ def column_mapping(env, columns):
     return mapping
 
 
-def trend_view(env, tgt_only=False):
-    if env is None:
-        print("Skipping plotting (env)")
-        return
+def regression_report(groupby, tgt_ewma, tgt_cols, branch_series, verdicts):
+    """
+    Comparison of the last value of each metric on the branch with the
+    last ewma of the target branch, with its change in percent and a
+    verdict: regression, improvement, unchanged or new. Verdicts from
+    the significance test take precedence.
+    """
+    report = []
+    for group_name, group_columns in groupby.items():
+        for col in sorted(group_columns):
+            if col not in branch_series.columns:
+                continue
+            value = float(branch_series[col].values[-1])
+            entry = {"metric": col, "group": group_name, "value": value}
+            baseline = float(tgt_ewma[col].iloc[-1]) if col in tgt_cols else math.nan
+            if math.isnan(baseline):
+                entry.update(baseline=None, change=None, verdict="new")
+            else:
+                change = (value - baseline) / abs(baseline) * 100 if baseline else None
+                worse = value < baseline if col.endswith("^") else value > baseline
+                if value == baseline:
+                    verdict = "unchanged"
+                else:
+                    verdict = "regression" if worse else "improvement"
+                entry.update(
+                    baseline=baseline,
+                    change=change,
+                    verdict=verdicts.get(col, verdict),
+                )
+            report.append(entry)
+    return report
+
+
+def render(
+    metrics_path,
+    groupby,
+    ncol,
+    tgt_only,
+    tgt_raw,
+    tgt_ewma,
+    tgt_cols,
+    branch_series,
+    tick_map,
+    tgt_anomalies,
+    verdicts,
+    tgt_points=None,
+    workers=1,
+    colors=None,
+    compress_level=6,
+):
+    """
+    Render one plot per group and stack them in <metrics_path>/diff.png.
+    The plot of each group is listed in <metrics_path>/plots.json.
+    """
+    # Imported here so that data-only runs do not import matplotlib or PIL
+    from cimetrics.render import render_group
+    from cimetrics.stack import write_stacked
 
-    try:
-        m = Metrics(env)
-    except ValueError as e:
-        sys.exit(str(e))
+    render_args = [
+        (
+            metrics_path,
+            group_name,
+            group_columns,
+            ncol,
+            tgt_only,
+            tgt_raw,
+            tgt_ewma,
+            tgt_cols,
+            branch_series,
+            tick_map,
+            tgt_anomalies,
+            verdicts,
+            tgt_points,
+        )
+        for group_name, group_columns in groupby.items()
+    ]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            files = list(executor.map(render_group, *zip(*render_args)))
+    else:
+        files = [render_group(*args) for args in render_args]
+    with open(os.path.join(metrics_path, "plots.json"), "w") as f:
+        json.dump(
+            [
+                {"group": group_name, "path": os.path.basename(path)}
+                for group_name, path in zip(groupby, files)
+            ],
+            f,
+            indent=2,
+        )
+
+    write_stacked(files, os.path.join(metrics_path, "diff.png"), colors, compress_level)
 
-    metrics_path = os.path.join(env.repo_root, "_cimetrics")
-    os.makedirs(metrics_path, exist_ok=True)
 
+def target_history(env, m, target_branch, tgt_only=False):
+    """
+    History of target_branch to compare branches against (or to monitor
+    if tgt_only), as (raw values, ewma, columns, build numbers by build
+    id, replicates). Replicates are only read for the significance test.
+    """
     span = env.monitoring_span if tgt_only else env.span
-    # Try to have enough data for all ewma points to be
+    # On a PR, the last ewma of the target branch, which the branch is
+    # compared against, can be read from its rollup when maintained
+    rollup = None
+    if env.rollups and not tgt_only:
+        rollup = read_rollup(m.col, target_branch, env.ewma_span)
+    # Otherwise, try to have enough data for all ewma points to be
     # calculated from a full window
-    build_span = span + env.ewma_span
+    build_span = span if rollup else span + env.ewma_span
 
-    tgt_raw, tick_map = m.branch_history(
-        {"branch": env.target_branch}, max_builds=build_span
-    )
+    tgt_query = {"branch": target_branch}
+    tgt_reps = None
+    if env.significance_test and not tgt_only:
+        tgt_raw, tick_map, tgt_reps = m.branch_history(
+            tgt_query, max_builds=build_span, replicates=True
+        )
+    else:
+        tgt_raw, tick_map = m.branch_history(tgt_query, max_builds=build_span)
+    if env.check_query_plans:
+        check_query_plans(
+            m.col,
+            history_queries(tgt_query),
+            [history_pipeline(m.col.name, tgt_query, None, build_span, HISTORY_FIELDS)],
+        )
     tgt_ewma = tgt_raw.ewm(span=env.ewma_span).mean()
-    tgt_cols = tgt_raw.columns
-    tgt_raw = tgt_raw.tail(span)
-    tgt_ewma = tgt_ewma.tail(span)
-    first_ax = None
+    if rollup and len(tgt_raw) and rollup["build_id"] == tgt_raw.index[-1]:
+        last_ewma = {s["name"]: s["ewma"] for s in rollup["metrics"]}
+        for col in tgt_ewma.columns:
+            if last_ewma.get(col) is not None:
+                tgt_ewma.loc[tgt_ewma.index[-1], col] = last_ewma[col]
+    elif rollup:
+        print(f"Rollup of {target_branch} is out of date, ignoring it")
+    return tgt_raw.tail(span), tgt_ewma.tail(span), tgt_raw.columns, tick_map, tgt_reps
+
+
+def trend_view(
+    env,
+    tgt_only=False,
+    plot=True,
+    target=None,
+    metrics_path=None,
+    executor=None,
+    m=None,
+):
+    """
+    Compare the branch with the target branch (or monitor the target
+    branch if tgt_only), and write the results to _cimetrics. diff.png is
+    only rendered if plot is set.
+
+    In batch mode, target is the history of the target branch, as
+    returned by target_history(), results are written to metrics_path,
+    and diff.png is rendered by executor. The future of the rendering
+    is then returned.
+    """
+    if env is None:
+        print("Skipping plotting (env)")
+        return
 
+    if m is None:
+        try:
+            m = Metrics(env)
+        except ValueError as e:
+            sys.exit(str(e))
+
+    if metrics_path is None:
+        metrics_path = os.path.join(env.repo_root, "_cimetrics")
+    os.makedirs(metrics_path, exist_ok=True)
+
+    if target is None:
+        target = target_history(env, m, env.target_branch, tgt_only)
+    tgt_raw, tgt_ewma, tgt_cols, tick_map, tgt_reps = target
+    # Shared with other branches in batch mode
+    tick_map = dict(tick_map)
+    significance_test = env.significance_test and not tgt_only
+
+    verdicts = {}
     if tgt_only:
         columns = sorted(tgt_raw.columns)
         ncol = env.monitoring_columns
         groupby = column_mapping(env, columns)
+        if env.anomaly_state and env.anomaly_detector == "builtin":
+            tgt_anomalies, events = incremental_anomalies(
+                m.col, env.target_branch, tgt_raw, env.ewma_span, build_numbers=tick_map
+            )
+            with open(os.path.join(metrics_path, "anomalies.json"), "w") as f:
+                json.dump(events, f, indent=2)
+            for event in events:
+                print(
+                    f"Level shift of {event['metric']} at build {event['build_id']}:"
+                    f" {event['before']} -> {event['after']}"
+                )
+        else:
+            tgt_anomalies = anomalies(tgt_raw, env.ewma_span, env.anomaly_detector)
     else:
         # On a PR, select older builds with the same PR id (assumed unique)
         # failing that, use the branch name, in which case we may pick up
@@ -209,201 +539,119 @@ def trend_view(env, tgt_only=False):
             query = {"pr_id": env.pull_request_id}
         else:
             query = {"branch": env.branch}
-        branch_series, branch_tick_map = m.branch_history(query, env.build_id)
+        if env.check_query_plans:
+            check_query_plans(
+                m.col,
+                history_queries(query),
+                [history_pipeline(m.col.name, query, env.build_id, 5, HISTORY_FIELDS)],
+            )
+        if significance_test:
+            branch_series, branch_tick_map, branch_reps = m.branch_history(
+                query, env.build_id, replicates=True
+            )
+            # Compare the replicates of the last build of the branch with
+            # those of the last significance_builds target builds
+            baseline = tgt_raw.index[-env.significance_builds :]
+            comparison = compare(
+                tgt_reps[tgt_reps.index.isin(baseline)],
+                branch_reps[branch_reps.index == branch_series.index[-1]],
+                env.significance_level,
+            )
+            # Metrics without enough replicates keep the verdict from
+            # the moving average
+            verdicts = {
+                col: verdict
+                for col, verdict in comparison["verdict"].items()
+                if verdict != "insufficient data"
+            }
+        else:
+            branch_series, branch_tick_map = m.branch_history(query, env.build_id)
         tick_map.update(branch_tick_map)
         columns = sorted(branch_series.columns)
         ncol = env.columns
         groupby = column_mapping(env, columns)
-
-    files = []
-
-    for group_name, group_columns in groupby.items():
-        nrow = math.ceil(float(len(group_columns)) / ncol)
-        fig = plt.figure(figsize=(ncol * 3, nrow * 3))
-        for index, col in enumerate(sorted(group_columns)):
-            share = {}
-            if not tgt_only:
-                share["sharex"] = first_ax
-            ax = fig.add_subplot(nrow, ncol, index + 1, **share)
-            ax.set_facecolor(Color.BACKGROUND)
-            ax.yaxis.set_label_position("right")
-            ax.yaxis.tick_right()
-
-            if not first_ax:
-                first_ax = ax
-
-            interesting_ticks = []
-
-            if col in tgt_cols:
-                # Plot raw target branch data
-                ax.plot(
-                    tgt_raw[col].values,
-                    color=Color.TARGET_RAW,
-                    marker="o",
-                    markersize=2,
-                    linestyle="",
-                )
-                # Plot ewma of target branch data
-                ax.plot(tgt_ewma[col].values, color=Color.TARGET_TREND, linewidth=0.5)
-
-                _, ymax = plt.ylim()
-                if tgt_only:
-                    for anomaly in anomalies(tgt_raw[col].to_frame(), env.ewma_span):
-                        interesting_ticks.append(anomaly)
-                        ax.axvline(
-                            x=anomaly, color=Color.BAD, linestyle=":", linewidth=0.5
-                        )
-                        ev = tgt_ewma[col].iloc[anomaly]
-                        ax.text(
-                            anomaly,
-                            ymax,
-                            ticklabel_format(ev).format(value=ev),
-                            color=Color.BAD,
-                            rotation=-30,
-                            ha="right",
-                        )
-
-            if not tgt_only:
-                # Pick color direction
-                good_col, bad_col = Color.GOOD, Color.BAD
-                if col.endswith("^"):
-                    good_col, bad_col = bad_col, good_col
-
-                if col in branch_series.columns:
-                    branch_val = branch_series[col].values[-1]
-                    # Pick a marker, either caret up, down, or circle for new metrics
-                    if col in tgt_cols:
-                        lewm = tgt_ewma[col][tgt_ewma.index[-1]]
-                        marker, color = (
-                            (1, good_col) if branch_val < lewm else (1, bad_col)
-                        )
-                    else:
-                        lewm = branch_val
-                        marker, color = (1, Color.GOOD)
-
-                    # Plot marker for branch value
-                    marker_x = len(tgt_raw) + len(branch_series) - 1
-                    s = ax.plot(
-                        marker_x,
-                        [branch_val],
-                        color=color,
-                        marker=marker,
-                        markersize=8,
-                        linestyle="",
-                    )
-                    # Plot bar for branch value
-                    s = ax.plot(
-                        [marker_x, marker_x],
-                        [lewm, branch_val],
-                        color=color,
-                        linestyle="-",
-                        linewidth=2,
-                    )
-
-                    # Plot previous branch runs
-                    for bx, by in zip(
-                        range(len(tgt_raw), marker_x), branch_series[col]
-                    ):
-                        s = ax.plot(
-                            [bx, bx],
-                            [lewm, by],
-                            color=good_col if by < lewm else bad_col,
-                            linestyle="-",
-                            linewidth=2,
-                            alpha=0.3,
-                        )
-            # Set yticks to branch value and last ewma when applicable
-            yticks = []
-            if tgt_only:
-                yvals = tgt_raw[col].dropna().values
-                yticks.append(yvals.min())
-                yticks.append(yvals.max())
-            else:
-                yticks.append(branch_val)
-            if col in tgt_cols:
-                yticks.append(tgt_ewma[col].values[-1])
-            ax.yaxis.set_ticks(yticks, labels=[], fontsize="small")
-            mv, rv = None, None
-            if not tgt_only:
-                if col in tgt_ewma:
-                    percent_change = 100 * (branch_val - lewm) / lewm
-                    sign = "+" if percent_change > 0 else ""
-                    mv = branch_val
-                    rv = f"{sign}{percent_change:.0f}%"
-            ax.yaxis.set_major_formatter(
-                mtick.FuncFormatter(make_ticklabel_formatter(yticks[0], mv, rv))
-            )
-            padding = {}
-            if tgt_only:
-                padding["pad"] = 14
-            ax.set_title(
-                col.strip("^").strip(),
-                loc="left",
-                fontdict={"fontweight": "bold"},
-                color=Color.TITLES,
-                fontsize="small",
-                **padding,
+        tgt_anomalies = {}
+
+    # Long histories are decimated for plotting, keeping anomalies
+    tgt_points = None
+    if plot and env.max_plot_points:
+        raw_points = plot_points(tgt_raw, env.max_plot_points, tgt_anomalies)
+        if raw_points is not None:
+            tgt_points = {
+                "raw": raw_points,
+                "ewma": plot_points(tgt_ewma, env.max_plot_points, tgt_anomalies),
+            }
+
+    if plot and not groupby:
+        print("No metrics to plot")
+    html = plot and groupby and env.plot_format in ("html", "both")
+    png = plot and groupby and env.plot_format in ("png", "both")
+    # Outputs of previous runs that are not written again, which would
+    # otherwise be published as those of this run
+    stale = [] if html else ["diff.html"]
+    stale += [] if png else ["diff.png", "plots.json"]
+    for name in stale:
+        if os.path.exists(os.path.join(metrics_path, name)):
+            os.remove(os.path.join(metrics_path, name))
+    if html:
+        from cimetrics.report import report_data, write_report
+
+        write_report(
+            os.path.join(metrics_path, "diff.html"),
+            env.target_branch if tgt_only else f"{env.branch} vs {env.target_branch}",
+            report_data(
+                groupby,
+                ncol,
+                tgt_raw,
+                tgt_ewma,
+                tgt_cols,
+                None if tgt_only else branch_series,
+                tick_map,
+                tgt_anomalies,
+                verdicts,
+                tgt_points,
+            ),
+        )
+    rendering = None
+    if png:
+        render_args = (
+            metrics_path,
+            groupby,
+            ncol,
+            tgt_only,
+            tgt_raw,
+            tgt_ewma,
+            tgt_cols,
+            None if tgt_only else branch_series.copy(),
+            dict(tick_map),
+            tgt_anomalies,
+            verdicts,
+            tgt_points,
+        )
+        if executor is None:
+            render(
+                *render_args,
+                env.plot_workers,
+                env.png_colors,
+                env.png_compress_level,
             )
-            if tgt_only:
-                ax.tick_params(
-                    axis="y",
-                    which="both",
-                    color=Color.TARGET_TREND,
-                    length=3,
-                    width=1,
-                    direction="in",
-                )
-            else:
-                ax.tick_params(axis="y", right=False)
-            ax.tick_params(
-                axis="x",
-                which="both",
-                color=Color.TARGET_TREND,
-                length=3,
-                width=1,
-                direction="in",
+        else:
+            rendering = executor.submit(
+                render, *render_args, 1, env.png_colors, env.png_compress_level
             )
-            # Match tick colors with series they belong to
-            tls = ax.yaxis.get_ticklabels()
-            if not tgt_only:
-                tls[0].set_color(color)
-                if len(tls) > 1:
-                    tls[1].set_color(Color.TARGET_TREND)
-            # Don't print xticks for rows other than bottom if not
-            # in tgt_only mode
-            if (index < (ncol * (nrow - 1))) and not tgt_only:
-                plt.setp(ax.get_xticklabels(), visible=False)
-                plt.setp(ax.get_xticklines(), visible=False)
-                plt.setp(ax.spines.values(), visible=False)
-
-            xticks = [0] + interesting_ticks + [len(tgt_raw) - 1]
-            xticks_labels = [
-                fancy_date(tick_map[tgt_raw.index.values[i]]) for i in xticks
-            ]
-
-            if tgt_only:
-                plt.xticks(rotation=-30, ha="left")
-            else:
-                plt.xticks(ha="left")
-            ax.xaxis.set_ticks(xticks, labels=xticks_labels, fontsize="small")
-            plt.yticks(fontsize="small")
-
-        fig.suptitle(
-            group_name,
-            horizontalalignment="left",
-            x=0.01,
-            y=0.97,
-            fontweight="bold",
-            fontsize="large",
-            color=Color.TITLES,
-        )
-        plt.tight_layout()
-        path = os.path.join(metrics_path, f"{group_name}.png")
-        plt.savefig(path)
-        plt.close(fig)
-        files.append(path)
 
-    stack_vertically(files).save(os.path.join(metrics_path, "diff.png"))
+    if not tgt_only:
+        report = {
+            "branch": env.branch,
+            "build_id": env.build_id,
+            "target_branch": env.target_branch,
+            "target_build_id": int(tgt_raw.index[-1]) if len(tgt_raw) else None,
+            "metrics": regression_report(
+                groupby, tgt_ewma, tgt_cols, branch_series, verdicts
+            ),
+        }
+        with open(os.path.join(metrics_path, "diff.json"), "w") as f:
+            json.dump(report, f, indent=2)
 
     build_ids = sorted(tgt_raw.index)
     if build_ids:
@@ -415,7 +663,8 @@ def trend_view(env, tgt_only=False):
 
     disable_numparse = [1]  # 0 is the index (build_id), 1 is build_number
     tgt_build_number = [tick_map[tgt_raw.index.values[i]] for i in range(len(tgt_raw))]
-    tgt_raw.insert(loc=0, column="build_number", value=tgt_build_number)
+    # Long histories are summarised, to keep the comment within size limits
+    tgt_table = bucket_table(tgt_raw, tgt_build_number, env.max_table_rows)
     if tgt_only:
         branch_md = ""
     else:
@@ -425,13 +674,16 @@ def trend_view(env, tgt_only=False):
         branch_series.insert(loc=0, column="build_number", value=branch_build_number)
         branch_md = f"{env.branch}\n\n"
         branch_md += branch_series.to_markdown(disable_numparse=disable_numparse)
+        if significance_test:
+            branch_md += f"\n\n{env.branch} vs {env.target_branch}\n\n"
+            branch_md += comparison.to_markdown(floatfmt=".4g")
     md = f"""
 <details>
   <summary>Click to see table</summary>
   
   {env.target_branch}
   
-  {tgt_raw.to_markdown(disable_numparse=disable_numparse)}
+  {tgt_table.to_markdown(disable_numparse=disable_numparse)}
   
   {branch_md}
 </details>
@@ -440,7 +692,129 @@ def trend_view(env, tgt_only=False):
     with open(os.path.join(metrics_path, "diff.txt"), "w") as dtext:
         dtext.write(comment)
         dtext.write(md)
+    return rendering
+
+
+class BranchEnv(object):
+    """
+    Environment of the last build of a pull request or branch, plotted
+    in batch mode. Other attributes are those of env.
+    """
+
+    def __init__(self, env, build):
+        self.env = env
+        self.branch = build["branch"]
+        self.build_id = build["build_id"]
+        self.build_number = build.get("build_number", build["build_id"])
+        self.pull_request_id = build.get("pr_id")
+        self.target_branch = build.get("target_branch") or env.target_branch
+
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+
+    @property
+    def is_pr(self) -> bool:
+        return self.pull_request_id is not None
+
+    @property
+    def build_url(self) -> str:
+        return self.env.build_url_by_id(self.build_id)
+
+
+def batch_builds(env, m):
+    """
+    Last build of each pull request, and of each branch of
+    batch_branches, created in the last batch_max_age_days days.
+    """
+    since = datetime.datetime.now() - datetime.timedelta(days=env.batch_max_age_days)
+    query = {
+        "created": {"$gte": since},
+        "build_id": {"$nin": [None, ""]},
+        "$or": [{"is_pr": True}, {"branch": {"$in": env.batch_branches}}],
+    }
+    records = m.col.find(
+        query,
+        {"branch": 1, "build_id": 1, "build_number": 1, "pr_id": 1, "target_branch": 1},
+    ).sort([("created", pymongo.DESCENDING)])
+    builds = {}
+    for r in records:
+        # PR builds of a branch are not builds of that branch
+        key = ("pr", r["pr_id"]) if r.get("pr_id") else ("branch", r["branch"])
+        builds.setdefault(key, r)
+    return builds
+
+
+def batch_view(env, plot=True):
+    """
+    Compare the last build of each pull request and of each branch of
+    batch_branches with its target branch, writing the results of each
+    to _cimetrics/batch/<pr-id or branch>. The history of each target
+    branch is only read once, and plots are rendered by plot_workers
+    processes. Failures are logged and recorded in the index, without
+    stopping the batch.
+    """
+    if env is None:
+        print("Skipping batch plotting (env)")
+        return
+
+    try:
+        m = Metrics(env)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    batch_path = os.path.join(env.repo_root, "_cimetrics", "batch")
+    # Written even if there are no builds to plot
+    os.makedirs(batch_path, exist_ok=True)
+    builds = batch_builds(env, m)
+    print(f"Plotting {len(builds)} pull requests and branches")
+    targets = {}
+    index = []
+    renderings = []
+    with ProcessPoolExecutor(max(env.plot_workers, 1)) as executor:
+        for (kind, name), build in sorted(builds.items()):
+            branch_env = BranchEnv(env, build)
+            target_branch = branch_env.target_branch
+            if target_branch not in targets:
+                targets[target_branch] = target_history(env, m, target_branch)
+            directory = f"{kind}-{name}".replace("/", "-")
+            entry = {
+                "directory": directory,
+                "branch": branch_env.branch,
+                "pr_id": branch_env.pull_request_id,
+                "build_id": branch_env.build_id,
+                "target_branch": target_branch,
+            }
+            index.append(entry)
+            try:
+                rendering = trend_view(
+                    branch_env,
+                    plot=plot,
+                    target=targets[target_branch],
+                    metrics_path=os.path.join(batch_path, directory),
+                    executor=executor,
+                    m=m,
+                )
+            except Exception as e:
+                print(f"Failed to plot {directory}: {e}")
+                entry["error"] = str(e)
+                continue
+            if rendering is not None:
+                renderings.append((entry, rendering))
+        for entry, rendering in renderings:
+            try:
+                rendering.result()
+            except Exception as e:
+                print(f"Failed to render {entry['directory']}: {e}")
+                entry["error"] = str(e)
+    with open(os.path.join(batch_path, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
 
 
 if __name__ == "__main__":
-    trend_view(get_env(), not get_env().is_pr)
+    # --no-plot only writes diff.txt (and diff.json on Pull Requests)
+    # --batch plots all recent pull requests and batch_branches
+    env = get_env()
+    if "--batch" in sys.argv:
+        batch_view(env, "--no-plot" not in sys.argv)
+    else:
+        trend_view(env, env is not None and not env.is_pr, "--no-plot" not in sys.argv)
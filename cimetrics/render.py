@@ -0,0 +1,366 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import io
+import os
+import sys
+import math
+import time
+import numpy
+import matplotlib
+import matplotlib.style
+import matplotlib.ticker as mtick
+from matplotlib.artist import setp
+from matplotlib.colors import to_rgba
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+from cimetrics.sketch import percentile_bands
+from cimetrics.plot import Color
+
+# Rendering of the plots of cimetrics.plot, imported only when plotting
+# so that data-only runs do not import matplotlib.
+
+
+def ticklabel_format(value):
+    """
+    Pick formatter for ytick labels. If possible, just print out the
+    value with the same precision as the branch value. If that doesn't
+    fit, switch to scientific format.
+    """
+    bvs = str(value)
+    if len(bvs) < 7:
+        fp = len(bvs) - (bvs.index(".") + 1) if "." in bvs else 0
+        return f"{{value:.{fp}f}}"
+    else:
+        return "{value:.1e}"
+
+
+def make_ticklabel_formatter(value, match_value=None, append=None):
+    def ticklabel_formatter(val, _):
+        rv = ticklabel_format(value).format(value=val)
+        if match_value is not None and val == match_value:
+            rv = f"{rv}\n({append})"
+        return rv
+
+    return ticklabel_formatter
+
+
+def fancy_date(ds):
+    return f"$_{{{ds[:4]}}}${ds[4:]}"
+
+
+def branch_bars(x0, ys, lewm, good_col, bad_col, color):
+    """
+    Bars from lewm to each of the values ys of the branch, starting at
+    x0, as a single collection. The bar of the last value is drawn with
+    color, those of previous values with the color of their direction.
+    """
+    xs = numpy.arange(x0, x0 + len(ys))
+    colors = numpy.where(
+        (ys < lewm)[:, None],
+        to_rgba(good_col, 0.3),
+        to_rgba(bad_col, 0.3),
+    )
+    colors[-1] = to_rgba(color)
+    segments = numpy.stack(
+        [
+            numpy.column_stack([xs, numpy.full(len(xs), lewm)]),
+            numpy.column_stack([xs, ys]),
+        ],
+        axis=1,
+    )
+    drawn = ~numpy.isnan(ys)
+    return LineCollection(
+        segments[drawn],
+        colors=colors[drawn],
+        linewidths=2,
+        linestyle="-",
+        # As drawn by Line2D
+        capstyle="projecting",
+        zorder=2,
+    )
+
+
+def render_group(
+    metrics_path,
+    group_name,
+    group_columns,
+    ncol,
+    tgt_only,
+    tgt_raw,
+    tgt_ewma,
+    tgt_cols,
+    branch_series,
+    tick_map,
+    tgt_anomalies,
+    verdicts,
+    tgt_points=None,
+):
+    """
+    Render the plots of group_columns to <metrics_path>/<group_name>.png,
+    and return the path of that file. Only uses the object-oriented
+    matplotlib API, so that groups can be rendered in parallel. If
+    tgt_points is set, only the positions it holds for each column of
+    tgt_raw and tgt_ewma are plotted (see cimetrics.decimate).
+    """
+    first_ax = None
+    with matplotlib.style.context("ggplot"):
+        nrow = math.ceil(float(len(group_columns)) / ncol)
+        fig = Figure(figsize=(ncol * 3, nrow * 3))
+        for index, col in enumerate(sorted(group_columns)):
+            share = {}
+            if not tgt_only:
+                share["sharex"] = first_ax
+            ax = fig.add_subplot(nrow, ncol, index + 1, **share)
+            ax.set_facecolor(Color.BACKGROUND)
+            ax.yaxis.set_label_position("right")
+            ax.yaxis.tick_right()
+
+            if not first_ax:
+                first_ax = ax
+
+            interesting_ticks = []
+
+            if col in tgt_cols:
+                raw_x = numpy.arange(len(tgt_raw))
+                ewma_x = raw_x
+                if tgt_points is not None:
+                    raw_x = tgt_points["raw"][col]
+                    ewma_x = tgt_points["ewma"][col]
+                # Plot raw target branch data
+                ax.plot(
+                    raw_x,
+                    tgt_raw[col].values[raw_x],
+                    color=Color.TARGET_RAW,
+                    marker="o",
+                    markersize=2,
+                    linestyle="",
+                )
+                # Shade bands up to the upper percentiles of recorded series
+                for band, alpha in percentile_bands(col, tgt_cols):
+                    ax.fill_between(
+                        raw_x,
+                        tgt_raw[col].values[raw_x],
+                        tgt_raw[band].values[raw_x],
+                        color=Color.TARGET_RAW,
+                        alpha=alpha,
+                        linewidth=0,
+                    )
+                # Plot ewma of target branch data
+                ax.plot(
+                    ewma_x,
+                    tgt_ewma[col].values[ewma_x],
+                    color=Color.TARGET_TREND,
+                    linewidth=0.5,
+                )
+
+                _, ymax = ax.get_ylim()
+                if tgt_only:
+                    for anomaly in tgt_anomalies[col]:
+                        interesting_ticks.append(anomaly)
+                        ax.axvline(
+                            x=anomaly, color=Color.BAD, linestyle=":", linewidth=0.5
+                        )
+                        ev = tgt_ewma[col].iloc[anomaly]
+                        ax.text(
+                            anomaly,
+                            ymax,
+                            ticklabel_format(ev).format(value=ev),
+                            color=Color.BAD,
+                            rotation=-30,
+                            ha="right",
+                        )
+
+            if not tgt_only:
+                # Pick color direction
+                good_col, bad_col = Color.GOOD, Color.BAD
+                if col.endswith("^"):
+                    good_col, bad_col = bad_col, good_col
+
+                if col in branch_series.columns:
+                    branch_val = branch_series[col].values[-1]
+                    # Pick a marker, either caret up, down, or circle for new metrics
+                    if col in tgt_cols:
+                        lewm = tgt_ewma[col][tgt_ewma.index[-1]]
+                        marker, color = (
+                            (1, good_col) if branch_val < lewm else (1, bad_col)
+                        )
+                        # Differences found to be noise are not colored
+                        if verdicts.get(col, "regression") not in (
+                            "regression",
+                            "improvement",
+                        ):
+                            color = Color.TARGET_TREND
+                    else:
+                        lewm = branch_val
+                        marker, color = (1, Color.GOOD)
+
+                    # Plot marker for branch value
+                    marker_x = len(tgt_raw) + len(branch_series) - 1
+                    ax.plot(
+                        marker_x,
+                        [branch_val],
+                        color=color,
+                        marker=marker,
+                        markersize=8,
+                        linestyle="",
+                    )
+
+                    # Plot bars for previous branch runs and branch value
+                    ax.add_collection(
+                        branch_bars(
+                            len(tgt_raw),
+                            branch_series[col].values,
+                            lewm,
+                            good_col,
+                            bad_col,
+                            color,
+                        )
+                    )
+                    ax.autoscale_view()
+            # Set yticks to branch value and last ewma when applicable
+            yticks = []
+            if tgt_only:
+                yvals = tgt_raw[col].dropna().values
+                yticks.append(yvals.min())
+                yticks.append(yvals.max())
+            else:
+                yticks.append(branch_val)
+            if col in tgt_cols:
+                yticks.append(tgt_ewma[col].values[-1])
+            ax.yaxis.set_ticks(yticks, labels=[], fontsize="small")
+            mv, rv = None, None
+            if not tgt_only:
+                if col in tgt_ewma:
+                    percent_change = 100 * (branch_val - lewm) / lewm
+                    sign = "+" if percent_change > 0 else ""
+                    mv = branch_val
+                    rv = f"{sign}{percent_change:.0f}%"
+            ax.yaxis.set_major_formatter(
+                mtick.FuncFormatter(make_ticklabel_formatter(yticks[0], mv, rv))
+            )
+            padding = {}
+            if tgt_only:
+                padding["pad"] = 14
+            ax.set_title(
+                col.strip("^").strip(),
+                loc="left",
+                fontdict={"fontweight": "bold"},
+                color=Color.TITLES,
+                fontsize="small",
+                **padding,
+            )
+            if tgt_only:
+                ax.tick_params(
+                    axis="y",
+                    which="both",
+                    color=Color.TARGET_TREND,
+                    length=3,
+                    width=1,
+                    direction="in",
+                )
+            else:
+                ax.tick_params(axis="y", right=False)
+            ax.tick_params(
+                axis="x",
+                which="both",
+                color=Color.TARGET_TREND,
+                length=3,
+                width=1,
+                direction="in",
+            )
+            # Match tick colors with series they belong to
+            tls = ax.yaxis.get_ticklabels()
+            if not tgt_only:
+                tls[0].set_color(color)
+                if len(tls) > 1:
+                    tls[1].set_color(Color.TARGET_TREND)
+            # Don't print xticks for rows other than bottom if not
+            # in tgt_only mode
+            if (index < (ncol * (nrow - 1))) and not tgt_only:
+                setp(ax.get_xticklabels(), visible=False)
+                setp(ax.get_xticklines(), visible=False)
+                setp(ax.spines.values(), visible=False)
+
+            xticks = [0] + interesting_ticks + [len(tgt_raw) - 1]
+            xticks_labels = [
+                fancy_date(tick_map[tgt_raw.index.values[i]]) for i in xticks
+            ]
+
+            if tgt_only:
+                setp(ax.get_xticklabels(), rotation=-30, ha="left")
+            else:
+                setp(ax.get_xticklabels(), ha="left")
+            ax.xaxis.set_ticks(xticks, labels=xticks_labels, fontsize="small")
+            setp(ax.get_yticklabels(), fontsize="small")
+
+        fig.suptitle(
+            group_name,
+            horizontalalignment="left",
+            x=0.01,
+            y=0.97,
+            fontweight="bold",
+            fontsize="large",
+            color=Color.TITLES,
+        )
+        fig.tight_layout()
+        path = os.path.join(metrics_path, f"{group_name}.png")
+        fig.savefig(path)
+        return path
+
+
+def plot_bars(ax, x0, ys, lewm, good_col, bad_col, color):
+    """
+    Bars of branch_bars() drawn with one line per value, as they were
+    before, for comparison.
+    """
+    for bx, by in zip(range(x0, x0 + len(ys) - 1), ys[:-1]):
+        ax.plot(
+            [bx, bx],
+            [lewm, by],
+            color=good_col if by < lewm else bad_col,
+            linestyle="-",
+            linewidth=2,
+            alpha=0.3,
+        )
+    ax.plot(
+        [x0 + len(ys) - 1] * 2,
+        [lewm, ys[-1]],
+        color=color,
+        linestyle="-",
+        linewidth=2,
+    )
+
+
+if __name__ == "__main__":
+    # Compare the number of artists and the rendering time of a group
+    # of metrics whose branch bars are drawn as one collection per plot,
+    # or with one line per build:
+    #
+    #   python -m cimetrics.render [metrics] [builds]
+    n_metrics = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    n_builds = int(sys.argv[2]) if len(sys.argv) > 2 else 150
+    ncol = 3
+    nrow = math.ceil(n_metrics / ncol)
+    rng = numpy.random.default_rng(0)
+    values = 100 + rng.normal(0, 5, (n_metrics, n_builds))
+
+    for name, draw in (("collection", None), ("lines", plot_bars)):
+        start = time.perf_counter()
+        fig = Figure(figsize=(ncol * 3, nrow * 3))
+        for index, ys in enumerate(values):
+            ax = fig.add_subplot(nrow, ncol, index + 1)
+            args = (0, ys, 100.0, Color.GOOD, Color.BAD, Color.BAD)
+            if draw is None:
+                ax.add_collection(branch_bars(*args))
+                ax.autoscale_view()
+            else:
+                draw(ax, *args)
+        artists = len(fig.findobj())
+        fig.savefig(io.BytesIO(), format="png")
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name}: {artists} artists, {elapsed * 1000:.0f}ms"
+            f" for {n_metrics} metrics over {n_builds} builds"
+        )
@@ -0,0 +1,189 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import json
+import math
+import html
+
+from cimetrics.plot import Color
+
+# Self-contained HTML report, an alternative to diff.png: the plotted
+# data is embedded as JSON, and drawn as SVG by the browser.
+
+TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+<style>
+body { font-family: sans-serif; color: __TITLES__; background: __BACKGROUND__; }
+h2 { font-size: 1.1em; margin: 1em 0 0.2em; }
+.group { display: grid; grid-template-columns: repeat(__COLUMNS__, 320px); gap: 8px; }
+.panel h3 { font-size: 0.8em; margin: 0.5em 0 0; }
+.panel svg { width: 320px; height: 200px; }
+.panel text { font-size: 10px; }
+</style>
+</head>
+<body>
+<div id="report"></div>
+<script>
+const data = __DATA__;
+const C = __COLORS__;
+const W = 320, H = 180, L = 8, R = 64, T = 14, B = 14;
+
+function esc(s) {
+  return String(s).replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;");
+}
+
+function panel(p) {
+  const raw = p.raw || [], ewma = p.ewma || [], branch = p.branch || [];
+  // Positions of decimated series, see cimetrics.decimate
+  const rx = p.raw_x || raw.map((_, i) => i), ex = p.ewma_x || ewma.map((_, i) => i);
+  const nt = raw.length ? data.builds.length : 0;
+  const n = nt + branch.length;
+  const values = raw.concat(ewma, branch).filter(v => v !== null);
+  let lo = Math.min(...values), hi = Math.max(...values);
+  if (lo === hi) { lo -= 1; hi += 1; }
+  const x = i => (L + i * (W - L - R) / Math.max(n - 1, 1)).toFixed(1);
+  const y = v => (T + (hi - v) * (H - T - B) / (hi - lo)).toFixed(1);
+  const path = (d, style) => `<path d="${d}" style="fill:none;${style}"/>`;
+  const text = (tx, ty, s, color, anchor) =>
+    `<text x="${tx}" y="${ty}" fill="${color}" text-anchor="${anchor || "start"}">${s}</text>`;
+  let svg = "";
+  for (const i of p.anomalies || []) {
+    svg += path(`M${x(i)} ${T}V${H - B}`, `stroke:${C.bad};stroke-dasharray:2 2`);
+    svg += text(x(i), T - 4, p.anomaly_values[i], C.bad, "end");
+  }
+  svg += path(raw.map((v, i) => v === null ? "" : `M${x(rx[i])} ${y(v)}h0`).join(""),
+              `stroke:${C.raw};stroke-width:4;stroke-linecap:round`);
+  svg += path(ewma.map((v, i) => v === null ? "" : `${i && ewma[i - 1] !== null ? "L" : "M"}${x(ex[i])} ${y(v)}`).join(""),
+              `stroke:${C.trend};stroke-width:1`);
+  if (branch.length) {
+    const base = p.baseline;
+    branch.forEach((v, j) => {
+      const color = p.better[j] ? C.good : C.bad;
+      svg += path(`M${x(nt + j)} ${y(base)}V${y(v)}`, `stroke:${color};stroke-width:3;opacity:0.3`);
+    });
+    const last = branch[branch.length - 1];
+    const color = p.neutral ? C.trend : (p.better[branch.length - 1] ? C.good : C.bad);
+    svg += path(`M${x(n - 1)} ${y(last)}h0`, `stroke:${color};stroke-width:8;stroke-linecap:round`);
+    svg += text(W - R + 6, y(last), `${last}${p.change === null ? "" : ` (${p.change})`}`, color);
+    if (nt) svg += text(W - R + 6, +y(base) + 10, base, C.trend);
+  } else if (ewma.length) {
+    svg += text(W - R + 6, y(ewma[ewma.length - 1]), ewma[ewma.length - 1], C.trend);
+  }
+  const builds = data.builds.concat(data.branch_builds);
+  if (builds.length) {
+    svg += text(L, H + 12, esc(builds[0]), C.titles);
+    svg += text(W - R, H + 12, esc(builds[builds.length - 1]), C.titles, "end");
+  }
+  return `<div class="panel"><h3>${esc(p.name)}</h3><svg viewBox="0 0 ${W} ${H + 20}">${svg}</svg></div>`;
+}
+
+document.getElementById("report").innerHTML = data.groups.map(g =>
+  `<h2>${esc(g.name)}</h2><div class="group">${g.panels.map(panel).join("")}</div>`).join("");
+</script>
+</body>
+</html>
+"""
+
+
+def rounded(values):
+    """
+    Values rounded to 6 significant digits, with NaNs as None, to keep
+    the embedded data compact.
+    """
+    return [None if v is None or math.isnan(v) else float(f"{v:.6g}") for v in values]
+
+
+def report_data(
+    groupby,
+    ncol,
+    tgt_raw,
+    tgt_ewma,
+    tgt_cols,
+    branch_series,
+    tick_map,
+    tgt_anomalies,
+    verdicts,
+    tgt_points=None,
+):
+    """
+    Data plotted by the report, with the same conventions as diff.png.
+    """
+    groups = []
+    for group_name, group_columns in groupby.items():
+        panels = []
+        for col in sorted(group_columns):
+            panel: dict = {"name": col}
+            if col in tgt_cols:
+                if tgt_points is None:
+                    panel["raw"] = rounded(tgt_raw[col].tolist())
+                    panel["ewma"] = rounded(tgt_ewma[col].tolist())
+                else:
+                    raw_x, ewma_x = tgt_points["raw"][col], tgt_points["ewma"][col]
+                    panel["raw"] = rounded(tgt_raw[col].values[raw_x].tolist())
+                    panel["raw_x"] = raw_x.tolist()
+                    panel["ewma"] = rounded(tgt_ewma[col].values[ewma_x].tolist())
+                    panel["ewma_x"] = ewma_x.tolist()
+                anomalies = list(tgt_anomalies.get(col, []))
+                panel["anomalies"] = anomalies
+                panel["anomaly_values"] = {
+                    i: rounded([tgt_ewma[col].iloc[i]])[0] for i in anomalies
+                }
+            if branch_series is not None and col in branch_series.columns:
+                values = branch_series[col].tolist()
+                if col in tgt_cols:
+                    baseline = tgt_ewma[col].iloc[-1]
+                    # Lower is better, unless the metric name ends with "^"
+                    better = [bool(v < baseline) != col.endswith("^") for v in values]
+                    change = (values[-1] - baseline) / abs(baseline) * 100
+                    panel["change"] = f"{change:+.0f}%"
+                else:
+                    baseline = values[-1]
+                    better = [True for _ in values]
+                    panel["change"] = None
+                panel["branch"] = rounded(values)
+                panel["baseline"] = rounded([baseline])[0]
+                panel["better"] = better
+                panel["neutral"] = verdicts.get(col, "regression") not in (
+                    "regression",
+                    "improvement",
+                )
+            panels.append(panel)
+        groups.append({"name": group_name, "panels": panels})
+    return {
+        "columns": ncol,
+        "builds": [tick_map[b] for b in tgt_raw.index],
+        "branch_builds": (
+            [] if branch_series is None else [tick_map[b] for b in branch_series.index]
+        ),
+        "groups": groups,
+    }
+
+
+def write_report(path, title, data):
+    """
+    Write the self-contained HTML report of data to path.
+    """
+    colors = {
+        "raw": Color.TARGET_RAW,
+        "trend": Color.TARGET_TREND,
+        "good": Color.GOOD,
+        "bad": Color.BAD,
+        "titles": Color.TITLES,
+    }
+    report = (
+        TEMPLATE.replace("__TITLE__", html.escape(title))
+        .replace("__TITLES__", Color.TITLES)
+        .replace("__BACKGROUND__", Color.BACKGROUND)
+        .replace("__COLUMNS__", str(data["columns"]))
+        .replace("__COLORS__", json.dumps(colors))
+        # Data can not close the script element
+        .replace(
+            "__DATA__", json.dumps(data, separators=(",", ":")).replace("</", "<\\/")
+        )
+    )
+    with open(path, "w") as f:
+        f.write(report)
+    return path
@@ -0,0 +1,144 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import sys
+import pymongo
+from typing import Dict, List
+
+from cimetrics import compact
+from cimetrics.env import get_env
+from cimetrics.connection import get_collection
+
+# Rollups hold, per branch, the state of the exponentially weighted
+# moving average of each metric over all complete builds, updated as
+# builds complete. The average matches pandas' ewm(span).mean(), i.e.
+# with adjust=True: ewma = num / den, where for each build
+# num = (1 - alpha) * num + value and den = (1 - alpha) * den + 1,
+# and both decay without being incremented when a metric is missing.
+
+
+def rollups_collection(col):
+    return col.database[f"{col.name}_rollups"]
+
+
+def document_metrics(docs: List[dict], col) -> List[Dict[str, dict]]:
+    """
+    metrics dict of each document, whichever its schema.
+    """
+    names = None
+    metrics = []
+    for doc in docs:
+        if compact.is_compact(doc):
+            if names is None:
+                names = compact.load_names(compact.names_collection(col))
+            metrics.append(compact.decode_metrics(doc, names))
+        else:
+            metrics.append(doc.get("metrics", {}))
+    return metrics
+
+
+def build_values(metrics: List[Dict[str, dict]]) -> Dict[str, float]:
+    """
+    Mean value of each metric over the documents of a build.
+    """
+    values: Dict[str, List[float]] = {}
+    for doc_metrics in metrics:
+        for name, metric in doc_metrics.items():
+            if metric.get("value") is not None:
+                values.setdefault(name, []).append(metric["value"])
+    values.pop("__complete", None)
+    return {name: sum(v) / len(v) for name, v in values.items()}
+
+
+def apply_build(rollup: dict, build_id: int, values: Dict[str, float]) -> dict:
+    """
+    Rollup updated with the metric values of a newer build.
+    """
+    decay = 1 - 2 / (rollup["ewma_span"] + 1)
+    metrics = {m["name"]: dict(m) for m in rollup["metrics"]}
+    for name, state in metrics.items():
+        state["num"] *= decay
+        state["den"] *= decay
+    for name, value in values.items():
+        state = metrics.setdefault(
+            name,
+            {
+                "name": name,
+                "num": 0.0,
+                "den": 0.0,
+                "count": 0,
+                "min": value,
+                "max": value,
+            },
+        )
+        state["num"] += value
+        state["den"] += 1
+        state["count"] += 1
+        state["min"] = min(state["min"], value)
+        state["max"] = max(state["max"], value)
+    for state in metrics.values():
+        state["ewma"] = state["num"] / state["den"] if state["den"] else None
+    return dict(rollup, build_id=build_id, metrics=list(metrics.values()))
+
+
+def update_rollup(col, branch: str, build_id, ewma_span: int) -> None:
+    """
+    Apply the complete build build_id of branch to its rollup, unless
+    the rollup already includes that build or a later one. The documents
+    of the build must have been inserted. A missing rollup, or one with
+    another ewma_span, is rebuilt from all the builds of branch.
+    """
+    rollups = rollups_collection(col)
+    build_id = int(build_id)
+    rollup = rollups.find_one({"_id": branch})
+    if rollup is None or rollup.get("ewma_span") != ewma_span:
+        rebuild_rollup(col, branch, ewma_span)
+        return
+    if rollup["build_id"] >= build_id:
+        return
+
+    docs = list(
+        col.find({"branch": branch, "build_id": {"$in": [str(build_id), build_id]}})
+    )
+    rollup = apply_build(rollup, build_id, build_values(document_metrics(docs, col)))
+    try:
+        rollups.replace_one(
+            {"_id": branch, "build_id": {"$lt": build_id}}, rollup, upsert=True
+        )
+    except pymongo.errors.DuplicateKeyError:
+        # Concurrently updated with a later build
+        pass
+
+
+def rebuild_rollup(col, branch: str, ewma_span: int) -> dict:
+    """
+    Recompute the rollup of branch from all its complete builds.
+    """
+    builds: Dict[int, List[dict]] = {}
+    for doc in col.find({"branch": branch, "build_id": {"$nin": [None, ""]}}):
+        builds.setdefault(int(doc["build_id"]), []).append(doc)
+    rollup = {"_id": branch, "build_id": -1, "ewma_span": ewma_span, "metrics": []}
+    for build_id in sorted(builds):
+        metrics = document_metrics(builds[build_id], col)
+        if any("__complete" in m for m in metrics):
+            rollup = apply_build(rollup, build_id, build_values(metrics))
+    rollups_collection(col).replace_one({"_id": branch}, rollup, upsert=True)
+    return rollup
+
+
+def read_rollup(col, branch: str, ewma_span: int):
+    rollup = rollups_collection(col).find_one({"_id": branch})
+    if rollup is None or rollup.get("ewma_span") != ewma_span:
+        return None
+    return rollup
+
+
+if __name__ == "__main__":
+    env = get_env()
+    if env is None:
+        print("Skipping rollup (env)")
+        sys.exit(0)
+
+    branch = sys.argv[1] if len(sys.argv) > 1 else env.target_branch
+    rollup = rebuild_rollup(get_collection(env), branch, env.ewma_span)
+    print(f"Rebuilt rollup of {branch} up to build {rollup['build_id']}")
@@ -0,0 +1,134 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import re
+import math
+import numpy
+from typing import Dict, List, Tuple
+
+# Summaries uploaded as metrics for each recorded series
+PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99, "max": 1.0}
+
+
+def percentile_metric(name: str, percentile: str) -> str:
+    """
+    Name of the metric holding a percentile of the series name, keeping
+    a trailing "^" (higher is better) at the end.
+    """
+    if name.endswith("^"):
+        return f"{name[:-1].rstrip()} [{percentile}] ^"
+    return f"{name} [{percentile}]"
+
+
+def percentile_bands(column: str, columns) -> List[Tuple[str, float]]:
+    """
+    For the median column of a recorded series, the columns of its
+    upper percentiles present in columns, with the opacity of their band.
+    """
+    match = re.match(r"^(.*) \[p50\]( \^)?$", column)
+    if not match:
+        return []
+    name = match.group(1) + (match.group(2) or "")
+    bands = [
+        (percentile_metric(name, "p90"), 0.4),
+        (percentile_metric(name, "p99"), 0.2),
+    ]
+    return [(band, alpha) for band, alpha in bands if band in columns]
+
+
+class Sketch(object):
+    """
+    Mergeable quantile sketch of non-negative, finite samples, with
+    relative accuracy alpha (DDSketch). Samples are counted in
+    logarithmic buckets, so memory only grows with the range of values
+    recorded.
+    """
+
+    def __init__(self, alpha: float = 0.01) -> None:
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, sample: float) -> None:
+        if not 0 <= sample < math.inf:
+            raise ValueError(
+                f"Negative or non-finite sample {sample} can not be recorded"
+            )
+        if sample == 0:
+            self.zeros += 1
+        else:
+            index = math.ceil(math.log(sample) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.min = min(self.min, sample)
+        self.max = max(self.max, sample)
+
+    def add_many(self, samples) -> None:
+        samples = numpy.asarray(samples, dtype=numpy.float64).ravel()
+        if not len(samples):
+            return
+        if not ((samples >= 0) & numpy.isfinite(samples)).all():
+            raise ValueError("Negative or non-finite samples can not be recorded")
+        positive = samples[samples > 0]
+        indexes, counts = numpy.unique(
+            numpy.ceil(numpy.log(positive) / self.log_gamma).astype(numpy.int64),
+            return_counts=True,
+        )
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += len(samples) - len(positive)
+        self.count += len(samples)
+        self.min = min(self.min, float(samples.min()))
+        self.max = max(self.max, float(samples.max()))
+
+    def merge(self, other: "Sketch") -> None:
+        assert self.alpha == other.alpha, "Can not merge sketches of different accuracy"
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return math.nan
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                value = 2 * self.gamma**index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        indexes = sorted(self.buckets)
+        return {
+            "alpha": self.alpha,
+            "zeros": self.zeros,
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "indexes": indexes,
+            "counts": [self.buckets[index] for index in indexes],
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Sketch":
+        sketch = cls(d["alpha"])
+        sketch.buckets = dict(zip(d["indexes"], d["counts"]))
+        sketch.zeros = d["zeros"]
+        sketch.count = d["count"]
+        sketch.min = d["min"]
+        sketch.max = d["max"]
+        return sketch
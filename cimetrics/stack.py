@@ -1,13 +1,29 @@
+import os
 import sys
+import time
+import zlib
+import struct
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy
 from PIL import Image
 
+BACKGROUND = (208, 215, 222)
+PADDING = 1
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Rows of the output compressed at once, and size of the IDAT chunks
+BAND_HEIGHT = 64
+IDAT_SIZE = 1 << 16
+
 
 def stack_vertically(img_paths):
     imgs = [Image.open(path) for path in img_paths]
     stacked_width = max(img.width for img in imgs)
-    padding = 1
+    padding = PADDING
     stacked_height = sum(img.height for img in imgs) + padding * (len(imgs) - 1)
-    stacked_img = Image.new("RGB", (stacked_width, stacked_height), (208, 215, 222))
+    stacked_img = Image.new("RGB", (stacked_width, stacked_height), BACKGROUND)
     yedge = 0
     for img in imgs:
         stacked_img.paste(img, (0, yedge))
@@ -15,5 +31,200 @@ def stack_vertically(img_paths):
     return stacked_img
 
 
+def write_chunk(f, kind, data):
+    f.write(struct.pack(">I", len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) & 0xFFFFFFFF))
+
+
+def stack_palette(img_paths, colors):
+    """
+    Palette of at most colors colors for all images, computed from
+    thumbnails of them and the background.
+    """
+    thumbs = []
+    for path in img_paths:
+        with Image.open(path) as img:
+            thumb = img.convert("RGB")
+            thumb.thumbnail((256, 256))
+            thumbs.append(thumb)
+    sample = Image.new(
+        "RGB",
+        (max(t.width for t in thumbs), sum(t.height for t in thumbs) + 1),
+        BACKGROUND,
+    )
+    y = 1
+    for thumb in thumbs:
+        sample.paste(thumb, (0, y))
+        y += thumb.height
+    return sample.quantize(colors)
+
+
+def bands(img_paths, width, palette=None):
+    """
+    Rows of the stacked image, as (rows, width) arrays of palette
+    indexes, or (rows, width, 3) RGB arrays, loading one image at a time.
+    """
+    dither = getattr(Image, "Dither", Image).NONE
+    if palette is not None:
+        background = numpy.asarray(
+            Image.new("RGB", (1, 1), BACKGROUND).quantize(
+                palette=palette, dither=dither
+            )
+        )[0, 0]
+    else:
+        background = numpy.array(BACKGROUND, dtype=numpy.uint8)
+    for index, path in enumerate(img_paths):
+        if index:
+            yield numpy.broadcast_to(
+                background, (PADDING, width) + background.shape
+            ).copy()
+        with Image.open(path) as img:
+            img = img.convert("RGB")
+            if palette is not None:
+                img = img.quantize(palette=palette, dither=dither)
+            for top in range(0, img.height, BAND_HEIGHT):
+                rows = numpy.asarray(
+                    img.crop((0, top, img.width, min(top + BAND_HEIGHT, img.height)))
+                )
+                band = numpy.empty((len(rows), width) + background.shape, numpy.uint8)
+                band[:] = background
+                band[:, : img.width] = rows
+                yield band
+
+
+def write_stacked(img_paths, path, colors=None, compress_level=6):
+    """
+    Stack the images of img_paths vertically, as stack_vertically(),
+    and write the result as a PNG to path. Rows are compressed as they
+    are produced, so that only one input image and one band of rows are
+    held in memory. If colors is set, the output is quantized to a
+    palette of at most that many colors, which makes it much smaller.
+    """
+    sizes = []
+    for img_path in img_paths:
+        with Image.open(img_path) as img:
+            sizes.append(img.size)
+    width = max(w for w, _ in sizes)
+    height = sum(h for _, h in sizes) + PADDING * (len(sizes) - 1)
+
+    palette = stack_palette(img_paths, colors) if colors else None
+    compressor = zlib.compressobj(compress_level)
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        color_type = 3 if palette else 2
+        write_chunk(
+            f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+        )
+        if palette:
+            write_chunk(f, b"PLTE", bytes(palette.getpalette()[:768]))
+
+        previous = None
+        pending = b""
+        for band in bands(img_paths, width, palette):
+            rows = band.reshape(len(band), -1)
+            if palette:
+                # No filtering, as recommended for palette images
+                filtered = numpy.hstack(
+                    [numpy.zeros((len(rows), 1), numpy.uint8), rows]
+                )
+            else:
+                # "Up" filter: difference with the row above
+                above = numpy.vstack(
+                    [
+                        (
+                            previous
+                            if previous is not None
+                            else numpy.zeros_like(rows[:1])
+                        ),
+                        rows[:-1],
+                    ]
+                )
+                filtered = numpy.hstack(
+                    [numpy.full((len(rows), 1), 2, numpy.uint8), rows - above]
+                )
+                previous = rows[-1:]
+            pending += compressor.compress(filtered.tobytes())
+            while len(pending) >= IDAT_SIZE:
+                write_chunk(f, b"IDAT", pending[:IDAT_SIZE])
+                pending = pending[IDAT_SIZE:]
+        write_chunk(f, b"IDAT", pending + compressor.flush())
+        write_chunk(f, b"IEND", b"")
+    return path
+
+
+def synthetic_plots(directory, count, size=(1800, 2400)):
+    """
+    Paths of count PNGs of size written to directory, with random lines
+    on a white background, for benchmarking.
+    """
+    from PIL import ImageDraw
+
+    rng = numpy.random.default_rng(0)
+    paths = []
+    for index in range(count):
+        img = Image.new("RGB", size, (255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        for _ in range(200):
+            xy = rng.integers(0, size, (8, 2)).flatten().tolist()
+            draw.line(xy, fill=tuple(rng.integers(0, 256, 3).tolist()), width=2)
+        path = os.path.join(directory, f"{index}.png")
+        img.save(path)
+        paths.append(path)
+    return paths
+
+
+def measure(method, img_paths, path, colors=None):
+    """
+    Wall time in seconds and peak RSS in MB of stacking img_paths to
+    path with method, "stack_vertically" or "write_stacked", meant to
+    run in a fresh process.
+    """
+    import resource
+
+    start = time.perf_counter()
+    if method == "stack_vertically":
+        stack_vertically(img_paths).save(path)
+    else:
+        write_stacked(img_paths, path, colors)
+    elapsed = time.perf_counter() - start
+    # In KB on Linux
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(img_paths, directory):
+    """
+    Compare stacking img_paths in memory with stack_vertically() and
+    streaming them with write_stacked(), each in a fresh process.
+    """
+    context = multiprocessing.get_context("spawn")
+    for method, colors in (
+        ("stack_vertically", None),
+        ("write_stacked", None),
+        ("write_stacked", 256),
+    ):
+        path = os.path.join(directory, "stacked.png")
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            elapsed, rss = executor.submit(
+                measure, method, img_paths, path, colors
+            ).result()
+        name = method + (f", {colors} colors" if colors else "")
+        size = os.path.getsize(path) / (1024 * 1024)
+        print(f"{name}: {elapsed:.1f}s, {rss:.0f}MB peak RSS, {size:.1f}MB")
+
+
 if __name__ == "__main__":
-    stack_vertically(sys.argv[1:]).save("stacked.png")
+    # Stack the given images to stacked.png, or compare the wall time
+    # and peak memory use of stacking them (by default, 20 synthetic
+    # plots) in memory and streaming them:
+    #
+    #   python -m cimetrics.stack --benchmark [images...]
+    if "--benchmark" in sys.argv:
+        img_paths = [arg for arg in sys.argv[1:] if arg != "--benchmark"]
+        with tempfile.TemporaryDirectory() as directory:
+            if not img_paths:
+                img_paths = synthetic_plots(directory, 20)
+            benchmark(img_paths, directory)
+    else:
+        write_stacked(sys.argv[1:], "stacked.png")
@@ -0,0 +1,172 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import math
+import warnings
+import numpy
+import pandas
+from typing import Tuple
+
+# Resamples used for bootstrap confidence intervals, drawn in chunks
+# to bound memory usage with many metrics and replicates
+BOOTSTRAP_SAMPLES = 1000
+BOOTSTRAP_CHUNK = 100
+CONFIDENCE = 0.95
+
+
+def samples(df: pandas.DataFrame) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Values of each column of df, sorted with NaNs last, and the number
+    of values in each column.
+    """
+    values = df.to_numpy(dtype=float)
+    return numpy.sort(values, axis=0), (~numpy.isnan(values)).sum(axis=0)
+
+
+def mann_whitney(target: numpy.ndarray, branch: numpy.ndarray) -> numpy.ndarray:
+    """
+    Two-sided p-values of the Mann-Whitney U test between the columns
+    of target and branch (NaN-padded), using the normal approximation
+    with tie correction.
+    """
+    n_t = (~numpy.isnan(target)).sum(axis=0)
+    n_b = (~numpy.isnan(branch)).sum(axis=0)
+    n = n_t + n_b
+    pooled = pandas.DataFrame(numpy.vstack([target, branch]))
+    ranks = pooled.rank(method="average").to_numpy()
+    # Size of the group of ties each value belongs to
+    ties = (pooled.rank(method="max") - pooled.rank(method="min") + 1).to_numpy()
+    u = numpy.nansum(ranks[len(target) :], axis=0) - n_b * (n_b + 1) / 2
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        tie_correction = numpy.nansum(ties**2 - 1, axis=0) / (n * (n - 1))
+        sigma = numpy.sqrt(n_t * n_b / 12 * ((n + 1) - tie_correction))
+        z = (u - n_t * n_b / 2) / sigma
+    return numpy.array(
+        [math.erfc(abs(v) / math.sqrt(2)) if numpy.isfinite(v) else 1.0 for v in z]
+    )
+
+
+def min_p_value(n_t: numpy.ndarray, n_b: numpy.ndarray) -> numpy.ndarray:
+    """
+    Smallest p-value mann_whitney() can return for samples of sizes n_t
+    and n_b, when all values of one sample are above those of the other.
+    """
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        z = n_t * n_b / 2 / numpy.sqrt(n_t * n_b * (n_t + n_b + 1) / 12)
+    return numpy.array(
+        [math.erfc(v / math.sqrt(2)) if numpy.isfinite(v) else 1.0 for v in z]
+    )
+
+
+def benjamini_hochberg(p_values: numpy.ndarray) -> numpy.ndarray:
+    """
+    p-values adjusted for testing many metrics at once, controlling the
+    false discovery rate (q-values).
+    """
+    order = numpy.argsort(p_values)
+    ranked = p_values[order] * len(p_values) / numpy.arange(1, len(p_values) + 1)
+    q_values = numpy.empty_like(p_values)
+    q_values[order] = numpy.minimum.accumulate(ranked[::-1])[::-1].clip(max=1)
+    return q_values
+
+
+def resampled_means(
+    values: numpy.ndarray, counts: numpy.ndarray, resamples: int, rng
+) -> numpy.ndarray:
+    """
+    Means of resamples bootstrap resamples of each column of values
+    (sorted with NaNs last, as returned by samples()).
+    """
+    size = max(int(counts.max(initial=0)), 1)
+    columns = len(counts)
+    draws = rng.random((resamples, size, columns), dtype=numpy.float32)
+    # Flat indexes of the picked values, in row-major order
+    picks = (draws * counts).astype(numpy.intp) * columns + numpy.arange(columns)
+    picked = values[:size].ravel()[picks]
+    if (counts < size).any():
+        picked[:, numpy.arange(size)[:, None] >= counts] = 0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return picked.sum(axis=1) / counts
+
+
+def bootstrap_change(
+    target: numpy.ndarray,
+    n_t: numpy.ndarray,
+    branch: numpy.ndarray,
+    n_b: numpy.ndarray,
+    rng,
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Bootstrap confidence interval of the relative change of the mean of
+    each column, from target to branch.
+    """
+    changes = numpy.empty((BOOTSTRAP_SAMPLES, len(n_t)))
+    for start in range(0, BOOTSTRAP_SAMPLES, BOOTSTRAP_CHUNK):
+        resamples = min(BOOTSTRAP_CHUNK, BOOTSTRAP_SAMPLES - start)
+        t_means = resampled_means(target, n_t, resamples, rng)
+        b_means = resampled_means(branch, n_b, resamples, rng)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            changes[start : start + resamples] = (b_means - t_means) / numpy.abs(
+                t_means
+            )
+    tail = (1 - CONFIDENCE) / 2 * 100
+    low, high = numpy.percentile(changes, [tail, 100 - tail], axis=0)
+    return low, high
+
+
+def compare(
+    target: pandas.DataFrame,
+    branch: pandas.DataFrame,
+    level: float = 0.05,
+    seed: int = 0,
+) -> pandas.DataFrame:
+    """
+    Compare the replicates of each metric on a branch (one row per
+    replicate) with those of the target branch, for all metrics at once.
+    A metric is a regression or an improvement only if the Mann-Whitney
+    test is significant at level, after adjusting for the number of
+    metrics, and the confidence interval of the relative change of its
+    mean excludes 0. Otherwise, the difference is noise. Metrics with
+    too few replicates for any difference to be significant at level
+    (e.g. a single replicate on the branch) have insufficient data.
+    Metrics whose name ends with "^" are better when higher.
+    """
+    columns = [col for col in branch.columns if col in target.columns]
+    t_values, n_t = samples(target[columns])
+    b_values, n_b = samples(branch[columns])
+    p_values = mann_whitney(t_values, b_values)
+    q_values = benjamini_hochberg(p_values)
+    low, high = bootstrap_change(
+        t_values, n_t, b_values, n_b, numpy.random.default_rng(seed)
+    )
+    with warnings.catch_warnings(), numpy.errstate(divide="ignore", invalid="ignore"):
+        # Metrics without values have a NaN mean
+        warnings.simplefilter("ignore", RuntimeWarning)
+        t_mean = numpy.nanmean(t_values, axis=0)
+        b_mean = numpy.nanmean(b_values, axis=0)
+        change = (b_mean - t_mean) / numpy.abs(t_mean)
+    higher_is_better = numpy.array([col.endswith("^") for col in columns], dtype=bool)
+    worse = numpy.where(higher_is_better, change < 0, change > 0)
+    significant = (q_values < level) & ((low > 0) | (high < 0))
+    verdict = numpy.where(
+        (n_t < 2) | (n_b < 2) | (min_p_value(n_t, n_b) >= level),
+        "insufficient data",
+        numpy.where(
+            significant, numpy.where(worse, "regression", "improvement"), "noise"
+        ),
+    )
+    return pandas.DataFrame(
+        {
+            "target_mean": t_mean,
+            "branch_mean": b_mean,
+            "change": change,
+            "ci_low": low,
+            "ci_high": high,
+            "p_value": p_values,
+            "q_value": q_values,
+            "target_samples": n_t,
+            "branch_samples": n_b,
+            "verdict": verdict,
+        },
+        index=pandas.Index(columns, name="metric"),
+    )
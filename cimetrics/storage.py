@@ -0,0 +1,101 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import hashlib
+import tempfile
+
+# Images are named after their contents, so that a name always refers
+# to the same image and can be cached forever
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def content_name(contents: bytes, extension: str = "png") -> str:
+    return f"plot-{hashlib.sha256(contents).hexdigest()}.{extension}"
+
+
+class AzureBlobStorage(object):
+    """
+    Images stored as blobs of a container of an Azure storage account
+    (or of Azurite, using a connection string), and served from web_url.
+    """
+
+    def __init__(
+        self, account_url=None, web_url=None, container="$web", connection_string=None
+    ):
+        # Imported here so that other backends do not need the Azure SDK
+        from azure.storage.blob import BlobServiceClient
+
+        if connection_string:
+            service = BlobServiceClient.from_connection_string(connection_string)
+        else:
+            service = BlobServiceClient(account_url=account_url)
+        self.container = service.get_container_client(container)
+        self.web_url = web_url or self.container.url
+
+    def exists(self, name: str) -> bool:
+        return self.container.get_blob_client(name).exists()
+
+    def upload(self, name: str, contents: bytes, content_type: str):
+        from azure.core.exceptions import ResourceExistsError
+        from azure.storage.blob import ContentSettings
+
+        try:
+            self.container.get_blob_client(name).upload_blob(
+                contents,
+                overwrite=False,
+                content_settings=ContentSettings(
+                    content_type=content_type, cache_control=IMMUTABLE
+                ),
+            )
+        except ResourceExistsError:
+            # Uploaded concurrently, with the same contents
+            pass
+
+    def url(self, name: str) -> str:
+        return f"{self.web_url}/{name}"
+
+
+class LocalStorage(object):
+    """
+    Images stored as files of the directory root, served from web_url.
+    """
+
+    def __init__(self, root, web_url=None):
+        self.root = root
+        self.web_url = web_url or f"file://{os.path.abspath(root)}"
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(os.path.join(self.root, name))
+
+    def upload(self, name: str, contents: bytes, content_type: str):
+        os.makedirs(self.root, exist_ok=True)
+        # Written to a temporary file first, so that an image is never
+        # seen partially written
+        fd, tmp = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, os.path.join(self.root, name))
+
+    def url(self, name: str) -> str:
+        return f"{self.web_url}/{name}"
+
+
+def get_storage(env):
+    """
+    Storage backend of the images published on pull requests, as
+    configured by image_storage.
+    """
+    if env.image_storage == "azure":
+        return AzureBlobStorage(
+            os.getenv("AZURE_BLOB_URL"),
+            os.getenv("AZURE_WEB_URL"),
+            connection_string=os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
+        )
+    elif env.image_storage == "local":
+        return LocalStorage(
+            os.path.join(env.repo_root, env.image_storage_path),
+            os.getenv("IMAGE_WEB_URL"),
+        )
+    raise ValueError(f"Unsupported image storage: {env.image_storage}")
@@ -1,30 +1,383 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import time
+import queue
+import atexit
 import datetime
+import threading
 import contextlib
-import pymongo
-from typing import Dict, Iterator
+from typing import Callable, Dict, Iterator, List, Tuple, TYPE_CHECKING
 from dataclasses import dataclass, asdict
 
 from typing import Optional
-from cimetrics.env import get_env
+
+# Modules imported when publishing rather than here, so that importing
+# cimetrics.upload and creating Metrics instances stays cheap:
+# cimetrics.env (git, yaml), cimetrics.connection (pymongo),
+# cimetrics.sketch, cimetrics.compact and cimetrics.rollup (numpy).
+if TYPE_CHECKING:
+    from cimetrics.sketch import Sketch
 
 
 @dataclass
 class Metric:
     value: float
     group: Optional[str] = None
+    replicates: Optional[List[float]] = None
+
+
+class BufferedPublisher:
+    """
+    Accumulates documents published by many Metrics instances and
+    inserts them in bulk, once max_docs documents are buffered or the
+    oldest one has been buffered for max_delay seconds (from a timer
+    thread), and at exit. on_inserted callbacks passed with documents
+    are called once they have been inserted. Documents are converted
+    with encode, if set, when inserted.
+    """
+
+    def __init__(self, coll, encode: Optional[Callable[[dict], dict]] = None) -> None:
+        self.coll = coll
+        self.encode = encode
+        self.max_docs = 100
+        self.max_delay = 5.0
+        self.docs: List[dict] = []
+        self.callbacks: List[Callable[[], None]] = []
+        self.oldest: Optional[float] = None
+        self.timer: Optional[threading.Timer] = None
+        self.lock = threading.Lock()
+        # Held while inserting, so that flush() at exit waits for an
+        # insert started by the timer
+        self.insert_lock = threading.Lock()
+
+    def add(self, doc: dict, on_inserted: Optional[Callable[[], None]] = None) -> None:
+        with self.lock:
+            self.docs.append(doc)
+            if on_inserted is not None:
+                self.callbacks.append(on_inserted)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+                self.timer = threading.Timer(self.max_delay, self._flush_on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+            due = (
+                len(self.docs) >= self.max_docs
+                or time.monotonic() - self.oldest >= self.max_delay
+            )
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.insert_lock:
+            with self.lock:
+                docs, self.docs, self.oldest = self.docs, [], None
+                callbacks, self.callbacks = self.callbacks, []
+                timer, self.timer = self.timer, None
+            if timer is not None:
+                timer.cancel()
+            if docs and self.encode is not None:
+                docs = [self.encode(doc) for doc in docs]
+            if docs:
+                self.coll.insert_many(docs, ordered=False)
+            for on_inserted in callbacks:
+                on_inserted()
+
+    def _flush_on_timer(self) -> None:
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Failed to upload buffered metrics documents: {e}")
+
+
+class BackgroundPublisher:
+    """
+    Inserts documents from a background thread, in batches of whatever
+    has been queued since the previous insert. When the bounded queue
+    is full, add() either blocks or drops the document, depending on
+    policy ("block" or "drop"). Failed inserts are retried with
+    exponential backoff. on_inserted callbacks passed with documents are
+    called from the background thread once they have been inserted.
+    Documents are converted with encode, if set, in the background
+    thread.
+    """
+
+    def __init__(
+        self,
+        coll,
+        max_queue: int = 1000,
+        policy: str = "block",
+        retries: int = 5,
+        backoff: float = 0.5,
+        encode: Optional[Callable[[dict], dict]] = None,
+    ) -> None:
+        assert policy in ("block", "drop"), f"Unsupported queue policy: {policy}"
+        self.coll = coll
+        self.encode = encode
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, doc: dict, on_inserted: Optional[Callable[[], None]] = None) -> None:
+        import bson
+
+        # Documents that can not be encoded fail here, in the caller,
+        # rather than in the background thread
+        bson.encode(doc)
+        if self.policy == "block":
+            self.queue.put((doc, on_inserted))
+            return
+        try:
+            self.queue.put_nowait((doc, on_inserted))
+        except queue.Full:
+            print("Metrics were dropped since the upload queue is full.")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for all queued documents to be inserted (or given up on),
+        for at most timeout seconds. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _run(self) -> None:
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            docs = [doc for doc, _ in items]
+            try:
+                if self.encode is not None:
+                    docs = [self.encode(doc) for doc in docs]
+                if self._insert(docs):
+                    for _, on_inserted in items:
+                        if on_inserted is not None:
+                            on_inserted()
+            except Exception as e:
+                # The thread must keep running, and flush() returning
+                print(f"Failed to upload {len(docs)} metrics documents: {e}")
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _insert(self, docs: List[dict]) -> bool:
+        """
+        Insert docs, retrying failed inserts. Returns False if some
+        documents could not be inserted.
+        """
+        import pymongo
+
+        for attempt in range(self.retries + 1):
+            try:
+                self.coll.insert_many(docs, ordered=False)
+                return True
+            except pymongo.errors.BulkWriteError as e:
+                # Documents already inserted by a previous attempt keep
+                # their _id and fail with a duplicate key error (11000)
+                failed = {
+                    err["index"]
+                    for err in e.details.get("writeErrors", [])
+                    if err.get("code") != 11000
+                }
+                docs = [doc for index, doc in enumerate(docs) if index in failed]
+                if not docs:
+                    return True
+                error: Exception = e
+            except pymongo.errors.PyMongoError as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2**attempt)
+        print(f"Failed to upload {len(docs)} metrics documents: {error}")
+        return False
+
+
+_publishers: Dict[Tuple[str, str, str], BufferedPublisher] = {}
+_background_publishers: Dict[Tuple[str, str, str], BackgroundPublisher] = {}
+_flush_after_close = False
+
+
+def get_collection(env):
+    """
+    Collection of env, importing cimetrics.connection on first use. Its
+    clients are closed at exit, by a function registered after flush()
+    since it is imported later. flush() is then registered again, so
+    that it runs before the clients are closed (atexit functions run in
+    reverse order of registration).
+    """
+    global _flush_after_close
+    from cimetrics.connection import get_collection
+
+    if not _flush_after_close:
+        atexit.unregister(flush)
+        atexit.register(flush)
+        _flush_after_close = True
+    return get_collection(env)
+
+
+def encoder(env) -> Optional[Callable[[dict], dict]]:
+    """
+    Conversion of documents to the document_schema of env, done when
+    they are inserted, since registering metric names in the compact
+    schema queries the database.
+    """
+    if env.document_schema != "compact":
+        return None
+    col = get_collection(env)
+
+    def encode(doc: dict) -> dict:
+        from cimetrics import compact
+
+        return compact.encode(doc, compact.names_collection(col))
+
+    return encode
+
+
+def buffered_publisher(env) -> BufferedPublisher:
+    key = (env.mongo_connection, env.mongo_db, env.mongo_collection)
+    if key not in _publishers:
+        _publishers[key] = BufferedPublisher(get_collection(env), encoder(env))
+    return _publishers[key]
+
+
+def background_publisher(env) -> BackgroundPublisher:
+    key = (env.mongo_connection, env.mongo_db, env.mongo_collection)
+    if key not in _background_publishers:
+        _background_publishers[key] = BackgroundPublisher(
+            get_collection(env),
+            env.upload_queue_size,
+            env.upload_queue_policy,
+            env.upload_retries,
+            env.upload_retry_backoff,
+            encoder(env),
+        )
+    return _background_publishers[key]
+
+
+@atexit.register
+def flush(timeout: Optional[float] = None) -> bool:
+    """
+    Insert all documents held by buffered publishers, and wait for
+    background publishers to insert theirs, for at most timeout seconds.
+    Returns False if some documents are still pending.
+    """
+    for publisher in _publishers.values():
+        publisher.flush()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    done = True
+    for background in _background_publishers.values():
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        done = background.flush(remaining) and done
+    return done
 
 
 class Metrics:
-    def __init__(self, complete: bool = True) -> None:
-        self.env = get_env()
+    def __init__(
+        self, complete: bool = True, buffered: bool = False, background: bool = False
+    ) -> None:
+        self._env = None
+        self._env_resolved = False
         self.metrics: Dict[str, Metric] = {}
+        self.sketches: Dict[str, Tuple["Sketch", Optional[str]]] = {}
         self.complete = complete
+        self.buffered = buffered
+        self.background = background
+
+    @property
+    def env(self):
+        if not self._env_resolved:
+            from cimetrics.env import get_env
+
+            self._env = get_env()
+            self._env_resolved = True
+        return self._env
 
     def put(self, name: str, value: float, group: Optional[str] = None) -> None:
-        self.metrics[name] = Metric(value, group)
+        """
+        Publish value for the metric name. Putting the same metric again
+        adds a replicate, as with put_replicates().
+        """
+        metric = self.metrics.get(name)
+        if metric is None:
+            self.metrics[name] = Metric(value, group)
+        else:
+            values = metric.replicates or [float(metric.value)]
+            self.put_replicates(name, values + [float(value)], group)
+
+    def put_replicates(
+        self, name: str, values: List[float], group: Optional[str] = None
+    ) -> None:
+        """
+        Publish repeated measurements of the metric name, so that its
+        comparison with the target branch can account for their noise.
+        The value of the metric is their mean.
+        """
+        values = [float(v) for v in values]
+        self.metrics[name] = Metric(sum(values) / len(values), group, values)
+
+    def _sketch(self, name: str, group: Optional[str]) -> "Sketch":
+        from cimetrics.sketch import Sketch
+
+        if name not in self.sketches:
+            self.sketches[name] = (Sketch(), group)
+        return self.sketches[name][0]
+
+    def record(self, name: str, sample: float, group: Optional[str] = None) -> None:
+        """
+        Record one sample of the series name. Its percentiles are
+        published as metrics, along with a sketch of its distribution.
+        """
+        self._sketch(name, group).add(sample)
+
+    def record_many(self, name: str, samples, group: Optional[str] = None) -> None:
+        """
+        Record an array of samples of the series name.
+        """
+        self._sketch(name, group).add_many(samples)
+
+    def document(self) -> dict:
+        from cimetrics.sketch import PERCENTILES, percentile_metric
+
+        for name, (sketch, group) in self.sketches.items():
+            for percentile, q in PERCENTILES.items():
+                self.metrics[percentile_metric(name, percentile)] = Metric(
+                    sketch.quantile(q), group
+                )
+        doc = {
+            "created": datetime.datetime.now(),
+            "build_id": self.env.build_id,
+            "build_number": self.env.build_number,
+            "branch": self.env.branch,
+            "is_pr": self.env.is_pr,
+            "commit": self.env.commit,
+            "metrics": {
+                key: (
+                    asdict(metric)
+                    if metric.replicates
+                    else {"value": metric.value, "group": metric.group}
+                )
+                for key, metric in self.metrics.items()
+            },
+        }
+        if self.sketches:
+            doc["sketches"] = {
+                name: sketch.to_dict() for name, (sketch, _) in self.sketches.items()
+            }
+        if self.env.is_pr:
+            doc["target_branch"] = self.env.target_branch
+            doc["pr_id"] = self.env.pull_request_id
+        return doc
 
     def publish(self):
         if self.env is None:
@@ -39,13 +392,9 @@ class Metrics:
             )
             return
 
-        client = pymongo.MongoClient(self.env.mongo_connection)
-
-        db = None
-        coll = None
         try:
-            db = client[self.env.mongo_db]
-            coll = db[self.env.mongo_collection]
+            self.env.mongo_db
+            self.env.mongo_collection
         except KeyError:
             print(
                 'Results were not uploaded since "db" or "collection" have not been set.'
@@ -54,26 +403,43 @@ class Metrics:
             return
 
         if self.complete:
-            self.put("__complete", 1)
+            self.metrics["__complete"] = Metric(1)
 
-        doc = {
-            "created": datetime.datetime.now(),
-            "build_id": self.env.build_id,
-            "build_number": self.env.build_number,
-            "branch": self.env.branch,
-            "is_pr": self.env.is_pr,
-            "commit": self.env.commit,
-            "metrics": {key: asdict(metric) for key, metric in self.metrics.items()},
-        }
-        if self.env.is_pr:
-            doc["target_branch"] = self.env.target_branch
-            doc["pr_id"] = self.env.pull_request_id
+        doc = self.document()
+
+        # The rollup of the branch is updated from the documents of the
+        # build, so only once they have been inserted
+        on_inserted = None
+        if self.complete and not self.env.is_pr and self.env.rollups:
+            from cimetrics.rollup import update_rollup
+
+            col = get_collection(self.env)
+            branch, build_id = self.env.branch, self.env.build_id
+            ewma_span = self.env.ewma_span
+
+            def on_inserted():
+                update_rollup(col, branch, build_id, ewma_span)
 
-        coll.insert_one(doc)
+        if self.background:
+            background_publisher(self.env).add(doc, on_inserted)
+        elif self.buffered:
+            publisher = buffered_publisher(self.env)
+            publisher.max_docs = self.env.upload_buffer_size
+            publisher.max_delay = self.env.upload_buffer_seconds
+            publisher.add(doc, on_inserted)
+        else:
+            encode = encoder(self.env)
+            if encode is not None:
+                doc = encode(doc)
+            get_collection(self.env).insert_one(doc)
+            if on_inserted is not None:
+                on_inserted()
 
 
 @contextlib.contextmanager
-def metrics(complete: bool = True) -> Iterator[Metrics]:
-    m = Metrics(complete=complete)
+def metrics(
+    complete: bool = True, buffered: bool = False, background: bool = False
+) -> Iterator[Metrics]:
+    m = Metrics(complete=complete, buffered=buffered, background=background)
     yield m
     m.publish()